@@ -8,25 +8,24 @@ import cv2
 import numpy as np
 import scrcpy
 import uvicorn
-from adbutils import adb
+from adbutils import adb, AdbDevice
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from numpy import ndarray
 from scrcpy import LOCK_SCREEN_ORIENTATION_1
 
-from .config import log, config, global_dict, HOST_ADDR, get_mode
+from . import gamer
+from .config import log, config, HOST_ADDR, get_mode
+from .coords import stream_size
 from .gamer import SekaiGamer
+from .metrics import stage_metrics, stream_metrics
 from .models import SekaiStageContext, SekaiStage, SekaiStageOp
-from .stage import find_stage, load_stages
-from .util import priority_win, ImageFinder, ocr_extract_number
+from .record import EventLog, Recorder, RecordingControl
+from .stage import find_stage, load_stages, get_rois, get_watch, start_vision
+from .util import priority_win, ImageFinder, ocr_extract_number, check_stats, FrameMailbox
 
-client: scrcpy.Client
-ctx: SekaiStageContext = None
-frame: ndarray = np.zeros((1, 1, 3), np.uint8)
-frame_time = 0
-last_find_stage = 0
-timeout_count = 0
+sessions: list['Session'] = []
 
-ctx_lock = threading.Lock()
 net = FastAPI()
 img_mp_create_open = ImageFinder('mp_create_open')
 img_mp_id = ImageFinder('bmp_id')
@@ -34,12 +33,23 @@ img_mp_id = ImageFinder('bmp_id')
 
 @net.get("/bmp_room_id")
 def bmp_room_id():
+    # Only the first device can host a room
+    session = sessions[0]
+    ctx = session.ctx
+
+    # Copy the frame under the session lock: the decision loop replaces it, and frame_gray is assembled lazily into a
+    # buffer that is reused for every frame
+    with session.lock:
+        if ctx.playing:
+            return {"id": None}
+        gray, frame = ctx.frame_gray.copy(), ctx.frame.copy()
+
     # Check if the current frame is mp_create_open
-    if global_dict.get('playing') or not img_mp_create_open.check(ctx.frame_gray):
+    if not img_mp_create_open.check(gray):
         return {"id": None}
 
     # Find the room id
-    img = img_mp_id.get_region(ctx.frame)
+    img = img_mp_id.get_region(frame)
     # OCR
     room_id = ocr_extract_number(img)
     # Zfill to 5
@@ -48,119 +58,273 @@ def bmp_room_id():
     return {"id": room_id}
 
 
-def _loop():
-    global ctx, last_find_stage, timeout_count
+@net.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return stage_metrics.prometheus()
 
-    # Check if last find stage is too recent (< 1s)
-    if ctx.time - last_find_stage < 1000:
-        return
-    last_find_stage = ctx.time
 
-    with ctx_lock:
-        if not ctx.last_op_done:
-            return
+def push_metrics():
+    """
+    Push the metrics to InfluxDB every config.metrics_interval seconds. Runs on its own thread, so that a slow or
+    unreachable server doesn't hold up the decision loops.
+    """
+    # Imported lazily because influx pulls in the InfluxDB client. One client is kept for the life of the thread.
+    from .influx import InfluxDBClient, Point, SYNCHRONOUS
+    with InfluxDBClient(url=config.influx.url, token=config.influx.token, org=config.influx.org) as client:
+        write_api = client.write_api(write_options=SYNCHRONOUS)
+        while True:
+            time.sleep(config.metrics_interval)
+            try:
+                points = [Point.from_dict(p) for p in stage_metrics.points()]
+                write_api.write(bucket=config.influx.bucket, record=points)
+            except Exception as e:
+                log.error(f"Failed to push metrics: {e}")
+
+
+def stream_params(mode: str) -> tuple[int, int]:
+    """
+    Frame rate and bitrate of a stream mode ('menu' or 'play')
+    """
+    dev = config.device
+    if mode == 'menu' and dev.menu_fps:
+        return dev.menu_fps, dev.menu_bitrate or dev.bitrate
+    return dev.fps, dev.bitrate
 
-        # The context operation is complete, we need to look for the next stage
-        stage = find_stage(ctx, stages)
-        if not stage:
-            # Check if timeout has been reached
-            if ctx.time - ctx.last_op_done > ctx.last_op.next_stage_timeout * 1000:
-                log.error(f"Timeout and have not found the next stage: {ctx.last_op.next_stage}")
-                # Click
-                w, h = config.device.screen_size
-                tx, ty = w * 0.9, h * 0.9
-                ctx.tap(tx, ty)
-                ctx.tap(tx, ty)
-                ctx.tap(tx, ty)
-                # TODO: Handle timeout
-                ctx.last_op_done = ctx.time
-                timeout_count += 1
-
-            # If we waited a minute and still couldn't find the next stage, restart the app
-            if timeout_count > 20:
-                log.error("Too many timeouts, try restarting")
-                # Restart the app
-                client.device.shell('am force-stop com.sega.pjsekai')
-                time.sleep(2)
 
-            return
+class Session:
+    """
+    Automata for one device: its scrcpy client, its stage context, and the thread that makes decisions from its
+    frames. Stages (with their templates and the song finder), charts and metrics are shared by all sessions.
+    """
+    def __init__(self, serial: str, client: scrcpy.Client):
+        self.serial = serial
+        self.client = client
+        self.ctx = SekaiStageContext(self.client, np.zeros((1, 1, 3), np.uint8), {}, {}, time.time_ns() // 1_000_000,
+                                     SekaiStageOp("startup", [], set()), rois=get_rois(),
+                                     watch=get_watch())
+        self.frames = FrameMailbox()
+        self.lock = threading.Lock()
+        self.last_find_stage = 0
+        self.timeout_count = 0
+        self.resumed = 0  # When the decision loop last resumed after playing a song or reconnecting the stream (ns)
+        self.recorder: EventLog | None = None
+        self.recorded_order: list[str] | None = None  # Last check order saved to the recording
+        self.mode = 'menu'  # Stream mode, see set_mode
+        self.want_mode = 'menu'
+        self.mode_since = time.time()
+        self.stream_cpu: tuple[int, int] | None = None  # (thread id, thread CPU time in ns) at the last frame
+
+    @classmethod
+    def connect(cls, device: AdbDevice) -> 'Session':
+        """ Create a session with a scrcpy client for a device """
+        s = cls(device.serial, scrcpy.Client(
+            device=device,
+            lock_screen_orientation=LOCK_SCREEN_ORIENTATION_1,
+            max_fps=stream_params('menu')[0],
+            bitrate=stream_params('menu')[1],
+            max_width=stream_size[0],
+        ))
+        if config.record_frames:
+            s.recorder = Recorder.for_serial(s.serial)
+            s.client.control = RecordingControl(s.client.control, s.recorder)
+            log.info(f"[{s.serial}] Recording to {s.recorder.path}")
+        return s
+
+    def start(self):
+        def init():
+            print(f"[{self.serial}] Client started")
+            priority_win()
+
+        self.client.add_listener(scrcpy.EVENT_INIT, init)
+        self.client.add_listener(scrcpy.EVENT_FRAME, self.on_frame)
+        self.client.start(threaded=True)
+        threading.Thread(target=self.loop, name=f'automata-{self.serial}').start()
+
+    def find_next(self):
+        ctx = self.ctx
+        with self.lock:
+            if not ctx.last_op_done:
+                return
 
-        # Perform the operation
-        timeout_count = 0
-        log.info(f"[{ctx.time}] Entered stage {stage.name}")
-        op = stage.operate(ctx)
-        log.info(f"> Performing operation {op.name}")
-        ctx.last_op = op
-        ctx.last_op_done = None
+            # Look for the next stage on every changed frame once the last operation had time to take effect, and
+            # re-check an unchanged screen every second (mostly for the timeout below)
+            if ctx.time - ctx.last_op_done < config.frame_delay * 1000 or \
+                    ctx.time - self.last_find_stage < (config.frame_delay * 1000 if ctx.frame_changed else 1000):
+                return
+            self.last_find_stage = ctx.time
+            ctx.frame_changed or ctx.refresh()
+
+            # The context operation is complete, we need to look for the next stage
+            stage = find_stage(ctx, stages)
+            # The order depends on measured check times, a replay needs it to make the same decisions
+            if self.recorder and ctx.check_order != self.recorded_order:
+                self.recorded_order = ctx.check_order
+                self.recorder.event('order', names=ctx.check_order, time=ctx.time)
+            if not stage:
+                # Check if timeout has been reached
+                if ctx.time - ctx.last_op_done > ctx.last_op.next_stage_timeout * 1000:
+                    log.error(f"[{self.serial}] Timeout and have not found the next stage: {ctx.last_op.next_stage}")
+                    # Click
+                    w, h = stream_size
+                    tx, ty = w * 0.9, h * 0.9
+                    ctx.tap(tx, ty)
+                    ctx.tap(tx, ty)
+                    ctx.tap(tx, ty)
+                    # TODO: Handle timeout
+                    ctx.last_op_done = ctx.time
+                    self.timeout_count += 1
+
+                # If we waited a minute and still couldn't find the next stage, restart the app
+                if self.timeout_count > 20:
+                    log.error(f"[{self.serial}] Too many timeouts, try restarting")
+                    # Restart the app
+                    self.client.device.shell('am force-stop com.sega.pjsekai')
+                    time.sleep(2)
 
+                return
 
-def loop():
-    while frame_time == 0:
-        time.sleep(0.1)
+            # Perform the operation
+            self.timeout_count = 0
+            log.info(f"[{self.serial}] [{ctx.time}] Entered stage {stage.name}")
+            self.want_mode = stage.stream_mode
+            self.recorder and self.recorder.event('stage', name=stage.name, time=ctx.time)
+            op = stage.operate(ctx)
+            log.info(f"> Performing operation {op.name}")
+            self.recorder and self.recorder.event('op', name=op.name, time=ctx.time)
+            ctx.last_op = op
+            ctx.last_op_done = None
+
+    def process(self, frame: ndarray, frame_time: int):
+        """
+        Update the context with a new frame and continue the current operation
+        """
+        ctx = self.ctx
+        with self.lock:
+            # Create the frame context
+            ctx.next(frame, frame_time)
+
+            # If the context operation is not complete, continue the operation
+            if ctx.last_op_done is None:
+                ac = ctx.last_op.actions[ctx.last_op.action_i]
+                # Update the action
+                log.info(f"> Running action {type(ac).__name__} (started: {ac.started})")
+                started = ac.started
+                done = ac.run(ctx)
+                # Starting an action may change the screen
+                if not started:
+                    ctx.invalidate()
+                if not done:
+                    return
+                # It finished this time, move to the next action
+                ctx.last_op.action_i += 1
+                # Done with all actions in the operation
+                if ctx.last_op.action_i >= len(ctx.last_op.actions):
+                    log.info(f"> Operation completed: {ctx.last_op.name}")
+                    ctx.last_op_done = ctx.time
+
+    def finish_playing(self) -> bool:
+        """
+        Go back to stage detection a while after the song is done (when the gamer doesn't exit the process)
+
+        :return: Whether a song is still being played
+        """
+        p: SekaiGamer = self.ctx.playing
+        if not p:
+            return False
+        if not p.done or time.time_ns() - p.done_at < gamer.exit_delay * 1_000_000_000:
+            return True
+        with self.lock:
+            self.ctx.playing = None
+            self.ctx.last_op_done = time.time_ns() // 1_000_000
+            self.ctx.invalidate()
+        self.resumed = time.time_ns()
+        self.want_mode = 'menu'
+        return False
+
+    def set_mode(self):
+        """
+        Switch the stream to the wanted mode: 'menu' streams at config.device.menu_fps and menu_bitrate (when they
+        are set), 'play' (while a song is played) at fps and bitrate. scrcpy can't change them on a running stream,
+        so the client reconnects.
+        """
+        mode = self.want_mode
+        if mode == self.mode:
+            return
+        stream_metrics.left(self.mode, time.time() - self.mode_since)
+        self.mode, self.mode_since = mode, time.time()
+        fps, bitrate = stream_params(mode)
+        if (fps, bitrate) == (self.client.max_fps, self.client.bitrate):
+            return
 
-    while True:
-        if global_dict.get('playing'):
-            time.sleep(1)
-            continue
-
-        st = time.time_ns()
-        # Check frame timeout 10s
-        if st - frame_time > 10_000_000_000:
-            log.error("Frame timeout")
+        log.info(f"[{self.serial}] Switching the stream to {mode} mode ({fps} fps, {bitrate} bps)")
+        st = time.time()
+        try:
+            self.client.stop()
+            self.client.max_fps, self.client.bitrate = fps, bitrate
+            self.client.start(threaded=True)
+        except Exception as e:
+            log.error(f"[{self.serial}] Failed to reconnect the stream: {e}")
             os._exit(1)
-        _loop()
-        et = time.time_ns()
-        log.debug(f"Loop time: {(et - st) / 1_000_000:.2f}ms")
-        time.sleep(1)
+        stream_metrics.switch(mode, time.time() - st)
+        self.resumed = time.time_ns()
+
+    def loop(self):
+        seq = 0
+        while True:
+            # Wake up as soon as a new frame arrives, or every second to check for a frame timeout
+            got = self.frames.get(seq, timeout=1)
+            if got:
+                seq, frame, frame_time = got
+            if self.finish_playing():
+                continue
+
+            # Check frame timeout 10s
+            if self.frames.seq and time.time_ns() - max(self.frames.time, self.resumed) > 10_000_000_000:
+                log.error(f"[{self.serial}] Frame timeout")
+                os._exit(1)
+            if got is None:
+                continue
+
+            st = time.time_ns()
+            self.process(frame, frame_time)
+            self.recorder and self.recorder.frame(frame, frame_time, self.ctx.frame_changed)
+            self.find_next()
+            self.set_mode()
+            et = time.time_ns()
+            if self.ctx.time == self.last_find_stage:
+                rejected = sum(v for k, v in check_stats.items() if k.startswith('reject_'))
+                log.debug(f"[{self.serial}] Loop time: {(et - st) / 1_000_000:.2f}ms | "
+                          f"Early rejected checks: {rejected}/{check_stats['check']}")
+
+    def on_frame(self, frame: ndarray):
+        """
+        This is called when a new frame is received from the device
+        """
+        if frame is None:
+            return
 
+        # CPU time of this thread since the last frame: decoding this frame, and handling the last one
+        cpu, tid = time.thread_time_ns(), threading.get_ident()
+        if self.stream_cpu and self.stream_cpu[0] == tid:
+            stream_metrics.frame(self.mode, (cpu - self.stream_cpu[1]) / 1e9)
+        self.stream_cpu = tid, cpu
 
-def on_frame(new_frame: ndarray):
-    """
-    This is called when a new frame is received from the device
-    """
-    if new_frame is None:
-        return
-
-    # Gamer mode takes highest priority
-    p: SekaiGamer = global_dict.get('playing')
-    if p:
-        p.on_frame(new_frame)
-        return
-
-    global ctx, frame_time, frame
-    assert new_frame.shape == (config.device.screen_size[1], config.device.screen_size[0], 3), \
-        f"Frame shape mismatch: {new_frame.shape} != {config.device.screen_size[1], config.device.screen_size[0], 3}"
-
-    if config.debug:
-        cv2.imshow("Sekai Automata", new_frame)
-        cv2.waitKey(1)
-
-    # Check if ctx_lock is locked
-    if ctx_lock.locked():
-        return
-
-    frame = new_frame
-    frame_time = time.time_ns()
-
-    with ctx_lock:
-        # Create the frame context
-        ctx.next(frame)
-
-        # If the context operation is not complete, continue the operation
-        if ctx.last_op_done is None:
-            ac = ctx.last_op.actions[ctx.last_op.action_i]
-            # Update the action
-            log.info(f"> Running action {type(ac).__name__} (started: {ac.started})")
-            if not ac.run(ctx):
-                return
-            # It finished this time, move to the next action
-            ctx.last_op.action_i += 1
-            # Done with all actions in the operation
-            if ctx.last_op.action_i >= len(ctx.last_op.actions):
-                log.info(f"> Operation completed: {ctx.last_op.name}")
-                ctx.last_op_done = ctx.time
+        # Gamer mode takes highest priority
+        p: SekaiGamer = self.ctx.playing
+        if p:
+            p.on_frame(frame)
             return
 
+        assert frame.shape == (stream_size[1], stream_size[0], 3), \
+            f"Frame shape mismatch: {frame.shape} != {stream_size[1], stream_size[0], 3}"
+
+        if config.debug and self is sessions[0]:
+            cv2.imshow("Sekai Automata", frame)
+            cv2.waitKey(1)
+
+        # Hand the frame over to the loop thread
+        self.frames.put(frame)
+
 
 def control():
     # The control thread: Wait for user input
@@ -176,41 +340,40 @@ def uvicorn_thread():
     uvicorn.run(net, host="0.0.0.0", port=int(HOST_ADDR.split(":")[-1]))
 
 
-def run(adb_serial: str = None):
-    global client, ctx
+def run(adb_serials: list[str] = None):
+    """
+    Run the automata on one or more devices. All devices share the [device] section of the config.
 
-    adb_serial = adb_serial or config.device.adb_serial or environ.get('ADB_SERIAL')
+    :param adb_serials: Serials of the devices (also read from config.device.adb_serial or the ADB_SERIAL environment
+        variable, comma-separated). The first connected device is used when none is specified.
+    """
+    adb_serials = adb_serials or (config.device.adb_serial or environ.get('ADB_SERIAL') or '').split(',')
+    adb_serials = [s.strip() for s in adb_serials if s.strip()]
 
-    # Find device
+    # Find devices
     devices = adb.device_list()
-    device = [v for v in devices if v.serial == adb_serial] if adb_serial else devices
-    if not device:
-        raise ValueError(f"Device with serial {config.device.adb_serial} not found. Available devices: {devices}")
-
-    # Connect to device
-    client = scrcpy.Client(
-        device=device[0],
-        lock_screen_orientation=LOCK_SCREEN_ORIENTATION_1,
-        max_fps=config.device.fps,
-        bitrate=config.device.bitrate,
-        max_width=config.device.screen_size[0],
-    )
-
-    ctx = SekaiStageContext(client, frame, {}, {}, time.time_ns() // 1_000_000, SekaiStageOp("startup", [], set()))
-
-    def init():
-        print("Client started")
-        priority_win()
-
-    client.add_listener(scrcpy.EVENT_INIT, init)
-    client.add_listener(scrcpy.EVENT_FRAME, on_frame)
-
-    # Start the client
-    client.start(threaded=True)
+    found = [v for v in devices if v.serial in adb_serials] if adb_serials else devices[:1]
+    if not found or len(found) < len(adb_serials):
+        raise ValueError(f"Devices with serials {adb_serials} not found. Available devices: {devices}")
+
+    # With more than one device, a finished song must not restart the whole process
+    if len(found) > 1:
+        gamer.exit_when_done = False
+
+    if config.metrics_interval:
+        threading.Thread(target=push_metrics, name='push-metrics', daemon=True).start()
+
+    if config.vision_workers:
+        start_vision(config.vision_workers)
+        log.info(f"Checking stages in {config.vision_workers} worker processes")
+
+    # Connect to the devices
+    sessions.extend(Session.connect(d) for d in found)
+    for s in sessions:
+        s.start()
     threading.Thread(target=control).start()
     if get_mode() == 'host':
         threading.Thread(target=uvicorn_thread).start()
-    loop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,237 @@
+"""
+Stage detection benchmark
+
+Runs every ImageFinder and every frame-only stage against screenshots and reports how long each check takes and
+how well it classifies them:
+
+* ImageFinder level: the editor preview of each template (`stages/editor-{w}x{h}/{name}/preview.jpg`) is the screen
+  that template was cut from, so its own finder must fire on it. Other finders firing there are listed too (some are
+  legitimately on the same screen).
+* Stage level: screenshots in a corpus directory, labeled by their folder (`{corpus}/{stage name}/*.png`, `none`
+  for screens that no stage should claim), and the frames of recordings (see record.py) at which a stage was entered.
+  Reported as a confusion matrix of the label against the first stage (in name order) whose is_stage returns True.
+
+Both levels are repeated for a range of config.image_threshold values, to see how much margin the threshold has.
+Run `python -m automata.bench [--corpus DIR] [--recording DIR]`.
+"""
+import argparse
+import logging
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from .config import config, log
+from .coords import stream_size
+from .models import SekaiStage, SekaiStageContext
+from .record import Recording
+from .stage import get_rois, load_stages
+from .templates import sources
+from .util import ImageFinder, TemplateBank
+
+image_exts = {'.png', '.jpg', '.jpeg', '.webp'}
+default_thresholds = (0.8, 0.85, 0.88, 0.9, 0.92, 0.95)
+
+
+@dataclass
+class Sample:
+    source: str
+    frame: ndarray
+    label: str | None  # Expected stage name ('none' for no stage), None if unknown
+    template: str | None = None  # Name of the template this screen was captured for
+    gray: ndarray = None
+
+
+@dataclass
+class StageBench:
+    ns: dict[str, list[int]] = field(default_factory=dict)  # Stage -> is_stage time (ns) of each sample
+    predicted: list[str] = field(default_factory=list)  # First matching stage of each sample, 'none' if none
+    ambiguous: int = 0  # Samples matched by more than one stage
+
+
+def fit_screen(img: ndarray) -> ndarray:
+    """
+    Scale a screenshot to the stream width, then crop or pad it to the stream height (the 1080x536 templates were
+    scaled down from 2160x1080 captures the same way)
+    """
+    w, h = stream_size
+    if img.shape[1] != w:
+        img = cv2.resize(img, (w, round(img.shape[0] * w / img.shape[1])),
+                         interpolation=cv2.INTER_AREA if img.shape[1] > w else cv2.INTER_LINEAR)
+    if img.shape[0] < h:
+        img = np.concatenate([img, np.zeros((h - img.shape[0], w, 3), np.uint8)])
+    return np.ascontiguousarray(img[:h])
+
+
+def template_samples() -> list[Sample]:
+    """ The editor preview of every template, from the template set of the stream size or else the largest one """
+    sets = sources()
+    base = next((p for w, h, p in sets if (w, h) == stream_size), sets[0][2])
+    return [Sample(str(p.relative_to(base)), fit_screen(cv2.imread(str(p))), None,
+                   p.parent.relative_to(base).as_posix()) for p in sorted(base.glob('**/preview.jpg'))]
+
+
+def corpus_samples(path: Path) -> list[Sample]:
+    """ Screenshots labeled by the name of the folder they are in """
+    return [Sample(str(p.relative_to(path)), fit_screen(cv2.imread(str(p))), p.parent.name)
+            for p in sorted(path.glob('*/*')) if p.suffix.lower() in image_exts]
+
+
+def recording_samples(path: Path) -> list[Sample]:
+    """ Frames of a recording at which a stage was entered, labeled by that stage """
+    rec = Recording(path)
+    frame_ms = rec.index['time'] // 1_000_000
+    out = []
+    for e in rec.events:
+        if e['kind'] != 'stage':
+            continue
+        i = np.searchsorted(frame_ms, e['time'])
+        if i < len(rec) and frame_ms[i] == e['time']:
+            out.append(Sample(f"{path.name}#{i}", rec.frame(i).copy(), e['name']))
+    return out
+
+
+def time_ns(fn, repeat: int) -> tuple[object, int]:
+    """ Result of a call and its fastest time (ns) over several repeats """
+    best = None
+    for _ in range(repeat):
+        st = time.perf_counter_ns()
+        res = fn()
+        t = time.perf_counter_ns() - st
+        best = t if best is None else min(best, t)
+    return res, best
+
+
+def context(s: Sample) -> SekaiStageContext:
+    ctx = SekaiStageContext(None, s.frame, {}, {}, 0, None, rois=get_rois())
+    ctx._frame_gray = s.gray
+    return ctx
+
+
+def classify(stages: list[SekaiStage], samples: list[Sample], repeat: int = 0) -> StageBench:
+    """
+    Run every stage on every sample
+
+    :param stages: The stages, in the order that decides which one wins
+    :param samples: The samples
+    :param repeat: Time each is_stage call over this many repeats, 0 to skip timing
+    """
+    out = StageBench()
+    for s in samples:
+        hits = []
+        ctx = context(s)
+        for st in stages:
+            if repeat:
+                res, ns = time_ns(lambda: st.is_stage(ctx), repeat)
+                out.ns.setdefault(st.name, []).append(ns)
+            else:
+                res = st.is_stage(ctx)
+            res and hits.append(st.name)
+        out.predicted.append(hits[0] if hits else 'none')
+        out.ambiguous += len(hits) > 1
+    return out
+
+
+def confusion(labels: list[str], predicted: list[str]) -> str:
+    names = sorted(set(labels) | set(predicted))
+    counts = Counter(zip(labels, predicted))
+    width = max(len(n) for n in names)
+    head = 'label \\ predicted'
+    out = [f"{head:>{width}} " + ' '.join(f'{i:>4}' for i in range(len(names)))]
+    for i, a in enumerate(names):
+        out.append(f'{a:>{width}} ' + ' '.join(f'{counts[a, b] or ".":>4}' for b in names) + f'  ({i})')
+    return '\n'.join(out)
+
+
+def bench(samples: list[Sample], thresholds: tuple[float, ...] = default_thresholds, repeat: int = 5) -> None:
+    """
+    Run the benchmark and print the report
+    """
+    stages = [s for _, s in sorted(load_stages().items()) if s.frame_only]
+    finders = {f.name: f for f in ImageFinder.instances}
+    bank = TemplateBank(finders)
+
+    st = time.perf_counter_ns()
+    for s in samples:
+        s.gray = cv2.cvtColor(s.frame, cv2.COLOR_BGR2GRAY)
+    print(f"{len(samples)} samples, grayscale conversion {(time.perf_counter_ns() - st) / len(samples) / 1000:.0f} us "
+          f"per frame (full frame; stage detection converts only the template regions)")
+
+    # ImageFinder level
+    print(f"\n== ImageFinder.check ({len(finders)} finders) ==")
+    ns = {n: [time_ns(lambda: f.check(s.gray), repeat)[1] for s in samples] for n, f in finders.items()}
+    scores = [bank.scores(s.gray) for s in samples]
+    own = {s.template: sc.get(s.template) for s, sc in zip(samples, scores) if s.template in finders}
+    print(f"{'finder':28} {'ns/check':>9} {'own score':>9}  also fires on (score)")
+    for n in sorted(finders):
+        others = [f'{s.template or s.source} ({sc[n]:.2f})' for s, sc in zip(samples, scores)
+                  if s.template != n and sc[n] > config.image_threshold]
+        score = f'{own[n]:.3f}' if own.get(n) is not None else '-'
+        print(f"{n:28} {np.mean(ns[n]):9.0f} {score:>9}  {', '.join(others[:4])}"
+              + (f' +{len(others) - 4}' if len(others) > 4 else ''))
+    print(f"\n{'threshold':>9} {'own misses':>10} {'other hits':>10}")
+    for t in thresholds:
+        misses = sum(v is None or v <= t for v in own.values())
+        others = sum(v > t for s, sc in zip(samples, scores) for n, v in sc.items() if n != s.template)
+        print(f"{t:9.2f} {misses:>10} {others:>10}")
+
+    # Stage level
+    print(f"\n== SekaiStage.is_stage ({len(stages)} frame-only stages) ==")
+    res = classify(stages, samples, repeat)
+    print(f"{'stage':28} {'ns/check':>9} {'p99':>9} {'claims':>6}")
+    claims = Counter(res.predicted)
+    for st in stages:
+        t = np.array(res.ns[st.name])
+        print(f"{st.name:28} {t.mean():9.0f} {np.percentile(t, 99):9.0f} {claims[st.name]:>6}")
+    print(f"Matched by more than one stage: {res.ambiguous}/{len(samples)}")
+
+    labeled = [(i, s) for i, s in enumerate(samples) if s.label is not None]
+    if not labeled:
+        print("\nNo labeled samples, pass --corpus or --recording for the confusion matrix")
+        return
+    labels = [s.label for _, s in labeled]
+    print(f"\nConfusion matrix over {len(labeled)} labeled samples:")
+    print(confusion(labels, [res.predicted[i] for i, _ in labeled]))
+    wrong = [(s.source, s.label, res.predicted[i]) for i, s in labeled if res.predicted[i] != s.label]
+    for src, label, pred in wrong[:20]:
+        print(f"  {src}: {label} -> {pred}")
+
+    print(f"\n{'threshold':>9} {'correct':>8} {'missed':>7} {'wrong':>6}")
+    default = config.image_threshold
+    try:
+        for t in thresholds:
+            config.image_threshold = t
+            pred = classify(stages, [s for _, s in labeled]).predicted
+            ok = sum(a == b for a, b in zip(labels, pred))
+            missed = sum(a != 'none' and b == 'none' for a, b in zip(labels, pred))
+            print(f"{t:9.2f} {ok:>8} {missed:>7} {len(labels) - ok - missed:>6}")
+    finally:
+        config.image_threshold = default
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark stage detection on screenshots.")
+    parser.add_argument('--corpus', type=Path, action='append', default=[],
+                        help='Directory of screenshots in folders named by the expected stage (or "none")')
+    parser.add_argument('--recording', type=Path, action='append', default=[], help='Recording directory')
+    parser.add_argument('--no-templates', action='store_true', help='Skip the template previews')
+    parser.add_argument('--repeat', type=int, default=5, help='Time each check as the fastest of this many runs')
+    parser.add_argument('--thresholds', type=lambda s: tuple(float(v) for v in s.split(',')),
+                        default=default_thresholds, help='Comma-separated image_threshold values to compare')
+    args = parser.parse_args()
+
+    # Stages log ambiguous matches on every check, which would bury the report
+    log.setLevel(logging.ERROR)
+    samples = [] if args.no_templates else template_samples()
+    for p in args.corpus:
+        samples += corpus_samples(p)
+    for p in args.recording:
+        samples += recording_samples(p)
+    if not samples:
+        parser.error('no samples: --no-templates skips the template previews, '
+                     'and no --corpus/--recording image was found')
+    bench(samples, args.thresholds, args.repeat)
@@ -0,0 +1,132 @@
+"""
+Precompiled binary charts
+
+The JSON charts made by sus2json are compiled into one structured numpy array per difficulty (saved next to the
+JSON as `{difficulty}.{profile}.npy`), which can be memory-mapped and needs no per-note processing when a song
+starts. Touch positions depend on the device geometry, so each device profile gets its own cache file.
+
+Run `python -m automata.chart` to compile every chart under config.music_path.
+"""
+import hashlib
+import json
+import os
+from functools import lru_cache
+from glob import glob
+from pathlib import Path
+
+import numpy as np
+from numpy import ndarray
+
+from .config import config, log
+from .gamer import touch_positions
+
+dev = config.device
+
+# Bump when the layout below changes, so that old caches count as stale
+version = 1
+note_dtype = np.dtype([
+    ('t', '<i4'),  # Time in ms
+    ('tid', '<i4'),  # Touch id
+    ('slide', '<i4'),  # Index of the slide this note belongs to, -1 for taps
+    ('lane', 'i1'),  # NOT 0-indexed. The first lane is 2
+    ('width', 'i1'),
+    ('kind', 'i1'),  # Index in kinds
+    ('air', 'i1'),  # Index in air_types (type of the air note, or of the slide note's airNote)
+    ('tpo', '<f4'),  # Touch x position on this device
+])
+kinds = ('short', 'air', 'slide')
+air_types = ('', 'flick', 'flick left', 'flick right', 'slide bend middle', 'slide bend left', 'slide bend right',
+             'unknown')
+
+
+def profile() -> str:
+    """
+    Short key of the device geometry that touch positions are computed from
+    """
+    geo = [dev.screen_size, dev.corner_ld, dev.corner_lt, dev.corner_rt, dev.corner_rd, dev.touch_y, version]
+    return hashlib.md5(json.dumps(geo).encode()).hexdigest()[:8]
+
+
+def cache_path(p: Path) -> Path:
+    """
+    Path of the compiled cache of a JSON chart
+    """
+    return p.with_name(f'{p.stem}.{profile()}.npy')
+
+
+def compile_chart(notes: dict) -> ndarray:
+    """
+    Compile a JSON chart into a note array: all taps first (in chart order), then the notes of each slide
+
+    :param notes: The JSON chart ({'taps': [...], 'slides': [[...], ...]})
+    :return: The note array
+    """
+    def row(n: dict, slide: int) -> tuple:
+        lane = n['lane'] - 2
+        tpo = (touch_positions[lane] + touch_positions[lane + n['width']]) / 2
+        air = n['type'] if n['r'] == 'air' else (n.get('airNote') or {}).get('type', '')
+        air = air_types.index(air) if air in air_types else air_types.index('unknown')
+        return n['t'], n['tid'], slide, n['lane'], n['width'], kinds.index(n['r']), air, tpo
+
+    rows = [row(n, -1) for n in notes['taps']]
+    rows += [row(n, i) for i, s in enumerate(notes['slides']) for n in s]
+    return np.array(rows, dtype=note_dtype)
+
+
+def load_chart(p: Path) -> ndarray:
+    """
+    Load the note array of a JSON chart, from its cache when the cache is up to date. Otherwise the JSON is
+    compiled and the cache is rewritten. Recently loaded charts are kept in memory and shared (read-only) by every
+    device in the process.
+
+    :param p: Path of the JSON chart
+    :return: The note array
+    """
+    return _load_chart(p, p.stat().st_mtime)
+
+
+@lru_cache(maxsize=16)
+def _load_chart(p: Path, mtime: float) -> ndarray:
+    cp = cache_path(p)
+    if cp.is_file() and cp.stat().st_mtime >= p.stat().st_mtime:
+        try:
+            arr = np.load(cp, mmap_mode='r')
+            if arr.dtype == note_dtype:
+                return arr
+            log.warning(f"Chart cache {cp} has an outdated layout, recompiling")
+        except (ValueError, OSError) as e:
+            log.warning(f"Chart cache {cp} is unreadable ({e}), recompiling")
+
+    arr = compile_chart(json.loads(p.read_text('utf-8')))
+    # The helper processes of a room load the same chart at the same time: replace the cache atomically, so that
+    # no process maps a half-written file
+    tmp = cp.with_name(f'{cp.name}.{os.getpid()}.tmp')
+    try:
+        with tmp.open('wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, cp)
+    except OSError as e:
+        log.error(f"Failed to write chart cache {cp}: {e}")
+    arr.flags.writeable = False
+    return arr
+
+
+def chart_files() -> list[Path]:
+    """
+    All JSON charts under config.music_path
+    """
+    return sorted(Path(f) for d in glob(config.music_path.replace('{ID}', '*')) for f in glob(str(Path(d) / '*.json')))
+
+
+def compile_all() -> None:
+    """
+    Compile every chart under config.music_path
+    """
+    files = chart_files()
+    for p in files:
+        load_chart(p)
+    log.info(f"Compiled {len(files)} charts for device profile {profile()}")
+
+
+if __name__ == '__main__':
+    compile_all()
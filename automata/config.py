@@ -22,6 +22,7 @@ class InfluxConfig:
 class DeviceConfig:
     adb_serial: str
     screen_size: tuple[int, int]
+    stream_size: tuple[int, int] | None
     corner_ld: tuple[int, int]
     corner_lt: tuple[int, int]
     corner_rt: tuple[int, int]
@@ -34,6 +35,8 @@ class DeviceConfig:
     touch_y: int
     bitrate: int
     fps: int
+    menu_bitrate: int | None
+    menu_fps: int | None
 
 
 class Config:
@@ -41,8 +44,12 @@ class Config:
     influx: InfluxConfig
     debug: bool
     image_threshold: float
+    template_scales: list[float]
     frame_delay: float
     music_path: str
+    metrics_interval: float
+    vision_workers: int
+    record_frames: bool
 
 
 def toml_to_namespace(s: str) -> Any:
@@ -63,9 +70,6 @@ if environ.get('CONFIG_PATH'):
 config: Config = [toml_to_namespace(Path(f).read_text('utf-8')) for f in config_paths
                   if Path(f).is_file()][0]
 
-# Valid keys: 'playing'
-global_dict = {}
-
 
 def get_mode() -> Literal['host', 'helper', 'self']:
     return environ.get('MODE', 'host')
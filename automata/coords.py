@@ -0,0 +1,44 @@
+"""
+Screen and stream coordinates
+
+Device settings (corners, touch_y, the visual lines, early_late_px) are measured in screen_size pixels. With a
+smaller device.stream_size, scrcpy sends downscaled frames and expects touch positions in stream pixels as well (its
+server scales them back to the device). Anything measured in screen_size pixels goes through `stream` before it is
+used to read a frame or to touch. Image finders are loaded at the stream size directly (see templates.py), so their
+positions need no mapping.
+"""
+import numpy as np
+from numpy import ndarray
+
+from .config import config
+
+stream_size: tuple[int, int] = tuple(config.device.stream_size or config.device.screen_size)
+
+
+class Transform:
+    """
+    Scales coordinates from one pixel grid to another, rounding to the nearest pixel inside the target
+    """
+    def __init__(self, src: tuple[int, int], dst: tuple[int, int]):
+        self.size = dst
+        self.sx = dst[0] / src[0]
+        self.sy = dst[1] / src[1]
+
+    @staticmethod
+    def _map(v: float | ndarray, s: float, n: int) -> int | ndarray:
+        if isinstance(v, ndarray):
+            return np.clip(np.rint(v * s), 0, n - 1).astype(int)
+        return min(max(int(round(v * s)), 0), n - 1)
+
+    def x(self, x: float | ndarray) -> int | ndarray:
+        return self._map(x, self.sx, self.size[0])
+
+    def y(self, y: float | ndarray) -> int | ndarray:
+        return self._map(y, self.sy, self.size[1])
+
+    def point(self, x: float, y: float) -> tuple[int, int]:
+        return self.x(x), self.y(y)
+
+
+# Screen pixels -> stream pixels
+stream = Transform(config.device.screen_size, stream_size)
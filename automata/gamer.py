@@ -1,17 +1,19 @@
-import math
+import bisect
 import os
 import threading
 import time
 from pathlib import Path
 
-import cv2
 import numpy as np
-from scrcpy import ACTION_MOVE, Client, ACTION_UP, ACTION_DOWN
+from scrcpy import ACTION_MOVE, Client, ACTION_UP, ACTION_DOWN, const
+from scrcpy.control import ControlSender
 from hypy_utils import printc
 from numpy import ndarray
 
 from . import util
-from .config import config, global_dict, get_log_path
+from .config import config, get_log_path
+from .coords import stream
+from .record import RecordingControl
 
 dev = config.device
 
@@ -31,11 +33,38 @@ air_time_delta = 90
 light_threshold = int(0.7 * 255)
 
 # Colors for late/early
-late_early_px = dev.early_late_px
+late_early_px = stream.point(*dev.early_late_px)
 late = np.array((252, 85, 139))[[2, 1, 0]]
 fast = np.array((85, 170, 255))[[2, 1, 0]]
-late_early_ms = 1
 late_early_save = Path(__file__).parent / "delay.txt"
+late_early_lock = threading.Lock()
+
+# Exit the process a while after a song is done (to be restarted by the start script). When several devices run in
+# one process, their sessions go back to stage detection instead
+exit_when_done = True
+exit_delay = 5  # Seconds
+
+# Timing calibration (see TimingCalibrator). Offsets are in ms added to igt, positive plays notes later
+calib_init_var = 100  # Variance of the initial offset estimate (ms^2), before any judgement is seen
+calib_saved_var = 4  # Variance of an offset learned in a previous play
+calib_jump_ms = 5  # How far off a fast/late judgement suggests we are
+calib_drift_var = 0.05  # Variance added per judgement, so the estimate keeps following slow drift
+calib_streak_gain = 2  # Variance multiplier while judgements keep pointing the same way
+
+# The playback thread wakes up at every note, and at least this often (ms) while a slide or flick is moving
+play_tick_ms = 4
+# Longest time (ms) the playback thread sleeps at once, so that fast/late adjustments are picked up
+play_max_sleep_ms = 50
+
+# Note kinds and air types in chart note arrays (see chart.kinds and chart.air_types)
+KIND_SHORT, KIND_AIR, KIND_SLIDE = 0, 1, 2
+AIR_FLICK = 1
+AIR_BEND_MIDDLE = 4
+AIR_BENDS = (4, 5, 6)
+
+# Points sampled on each bent slide segment in the slide path table. Piecewise-linear sampling of the sine curves
+# is off by at most ~0.0003 of the segment's width at 32
+bend_samples = 32
 
 
 def interpolate_y() -> tuple[list[tuple[int, int]], tuple[ndarray, ndarray], list[int], list[float]]:
@@ -59,87 +88,373 @@ def interpolate_y() -> tuple[list[tuple[int, int]], tuple[ndarray, ndarray], lis
 
 ys = interpolate_y()
 
+# Start detection samples the grid pixels straight from the BGR frame. Each point gets the index of its visual line
+# (lines are sorted from the top, where notes appear) and each line the delay from it to the judgement line. The grid
+# is measured in screen pixels and read from stream pixels
+line_ys = sorted(set(ys[2]))
+grid_line = np.array([line_ys.index(y) for _, y in ys[0]])
+line_delay = [ys[3][ys[2].index(y)] for y in line_ys]
+grid_x, grid_y = stream.x(ys[1][0]), stream.y(ys[1][1])
+line_ys = [stream.y(y) for y in line_ys]
+gray_weights = np.array([0.114, 0.587, 0.299])  # BGR, same as cv2.COLOR_BGR2GRAY
+start_track_tol = 60  # Lines reached more than this (ms) off the current start estimate belong to other notes
+
+
+# Builds a touch message body without sending it (ControlSender.touch without its sending decorator)
+touch_body = getattr(ControlSender.touch, '__wrapped__', None)
+touch_header = bytes([const.TYPE_INJECT_TOUCH_EVENT])
+
+
+class TouchBatch:
+    """
+    Collects the touch events of one playback tick and sends them to the control socket in a single write.
+    Consecutive MOVEs of the same touch id are merged into the last one, and MOVEs that don't change the touch
+    position (after rounding to pixels) are dropped.
+    """
+    def __init__(self, client: Client):
+        self.client = client
+        self.events: list[list[int]] = []  # [x, y, action, tid]
+        self.moves: dict[int, int] = {}  # Touch id -> index in events of its pending MOVE
+        self.pos: dict[int, tuple[int, int]] = {}  # Touch id -> latest position of touches that are down
+        self.sent = 0
+        self.merged = 0
+
+    def add(self, x: int, y: int, action: int, tid: int) -> None:
+        if action == ACTION_MOVE:
+            if self.pos.get(tid) == (x, y):
+                self.merged += 1
+                return
+            if tid in self.moves:
+                self.events[self.moves[tid]][:2] = x, y
+                self.merged += 1
+            else:
+                self.moves[tid] = len(self.events)
+                self.events.append([x, y, action, tid])
+            self.pos[tid] = x, y
+            return
+
+        self.moves.pop(tid, None)
+        self.events.append([x, y, action, tid])
+        if action == ACTION_UP:
+            self.pos.pop(tid, None)
+        else:
+            self.pos[tid] = x, y
+
+    def flush(self) -> None:
+        """ Send all collected events """
+        if not self.events:
+            return
+        control, sock = self.client.control, self.client.control_socket
+        if touch_body is None or sock is None:
+            # Unknown scrcpy version or not connected: send them one by one
+            for e in self.events:
+                control.touch(*e)
+        else:
+            buf = b''.join(touch_header + touch_body(control, *e) for e in self.events)
+            with self.client.control_socket_lock:
+                sock.sendall(buf)
+            # The batch bypasses control.touch, log it the way a recording control logs the messages it sends
+            if isinstance(control, RecordingControl):
+                for e in self.events:
+                    control.log_call('touch', *e, batch=True)
+        self.sent += len(self.events)
+        self.events.clear()
+        self.moves.clear()
+
+
+def load_offset(serial: str) -> float:
+    """ Timing offset learned on a device in previous plays (ms) """
+    with late_early_lock:
+        if late_early_save.is_file():
+            for line in late_early_save.read_text('utf-8').splitlines():
+                key, _, offset = line.rpartition(' ')
+                if key == serial:
+                    try:
+                        return float(offset)
+                    except ValueError:
+                        printc(f"&cIgnoring malformed line in {late_early_save}: {line}")
+    return 0
+
+
+def save_offset(serial: str, offset: float) -> None:
+    """
+    Save the timing offset learned on a device, keeping other devices' offsets. The devices of a room (one process
+    each, see start1.ps1) finish a song together, so the file is re-read right before it is replaced atomically.
+    """
+    with late_early_lock:
+        lines = late_early_save.read_text('utf-8').splitlines() if late_early_save.is_file() else []
+        lines = [line for line in lines if line.rpartition(' ')[0] != serial]
+        tmp = late_early_save.with_name(f'{late_early_save.name}.{os.getpid()}.tmp')
+        try:
+            tmp.write_text('\n'.join(lines + [f'{serial} {offset:.2f}']) + '\n', 'utf-8')
+            os.replace(tmp, late_early_save)
+        except OSError as e:
+            printc(f"&cFailed to save the timing offset to {late_early_save}: {e}")
+
+
+class TimingCalibrator:
+    """
+    Scalar Kalman filter on the timing offset. A fast/late judgement is only a sign, so it is taken as a measurement
+    calib_jump_ms away from the current estimate. Judgements pointing the same way in a row inflate the variance,
+    which keeps the steps large until the sign flips, so a badly tuned delay converges within a few notes.
+    """
+    def __init__(self, offset: float = 0, var: float = calib_init_var):
+        self.offset = offset
+        self.var = var
+        self.streak = 0  # Number of consecutive fast (positive) or late (negative) judgements
+
+    def observe(self, is_fast: bool, is_late: bool) -> float:
+        """
+        Update the estimate with one judgement
+
+        :return: Change of the offset (ms)
+        """
+        if is_fast == is_late:
+            return 0
+        sign = 1 if is_fast else -1
+        self.streak = self.streak + sign if self.streak * sign > 0 else sign
+        if abs(self.streak) > 1:
+            self.var *= calib_streak_gain
+
+        self.var += calib_drift_var
+        gain = self.var / (self.var + calib_jump_ms ** 2)
+        delta = gain * calib_jump_ms * sign
+        self.offset += delta
+        self.var *= 1 - gain
+        return delta
+
+
+class FlickQueue:
+    """
+    Fixed-capacity ring buffer of ongoing flicks (end ela time, touch x, touch id), oldest first. Flicks don't
+    necessarily end in the order they were pushed (ela moves back when the start estimate shifts, and taps and
+    slide ends of the same tick aren't in chart order), so expired flicks are removed wherever they are.
+    """
+    def __init__(self, capacity: int = 32):
+        self.end = [0] * capacity
+        self.tpo = [0.0] * capacity
+        self.tid = [0] * capacity
+        self.head = 0
+        self.size = 0
+
+    def push(self, end: int, tpo: float, tid: int) -> None:
+        if self.size == len(self.end):
+            printc(f"&cFlick queue is full, dropping flick {tid}")
+            return
+        i = (self.head + self.size) % len(self.end)
+        self.end[i], self.tpo[i], self.tid[i] = end, tpo, tid
+        self.size += 1
+
+    def expire(self, now: int) -> list[tuple[float, int]]:
+        """
+        Remove the flicks that ended before now, keeping the order of the others
+
+        :param now: Current ela time
+        :return: (touch x, touch id) of each removed flick
+        """
+        done, keep, n = [], 0, len(self.end)
+        for k in range(self.size):
+            i = (self.head + k) % n
+            if self.end[i] < now:
+                done.append((self.tpo[i], self.tid[i]))
+                continue
+            j = (self.head + keep) % n
+            self.end[j], self.tpo[j], self.tid[j] = self.end[i], self.tpo[i], self.tid[i]
+            keep += 1
+        self.size = keep
+        return done
+
+    def indices(self) -> list[int]:
+        """ Ring indices from the oldest flick to the newest """
+        return [(self.head + k) % len(self.end) for k in range(self.size)]
+
+
+def slide_paths(t: ndarray, tpo: ndarray, air: ndarray, lengths: ndarray) -> tuple[ndarray, ndarray, float]:
+    """
+    Compile slide paths into one piecewise-linear lookup table. Each slide k occupies its own time range, with
+    times shifted by k * span, so that the positions of all ongoing slides can be looked up in a single np.interp.
+
+    :param t: Note times of all slides concatenated
+    :param tpo: Note touch x positions
+    :param air: Note air type indices (the bend of the segment starting at the note)
+    :param lengths: Number of notes of each slide
+    :return: Shifted sample times, touch x at those times, span
+    """
+    span = float(t.max() + 1) if len(t) else 1.
+    slide = np.repeat(np.arange(len(lengths)), lengths)
+    last = np.cumsum(lengths) - 1
+
+    # Sample each segment at r in [0, 1) (last notes only keep r = 0, they have no segment)
+    r = np.arange(bend_samples) / bend_samples
+    nxt = np.minimum(np.arange(len(t)) + 1, len(t) - 1)
+    curve = np.where(air[:, None] == AIR_BEND_MIDDLE, 1 - np.cos(r * np.pi / 2),
+                     np.where(np.isin(air, AIR_BENDS)[:, None], np.sin(r * np.pi / 2), r))
+    times = t[:, None] + (t[nxt] - t)[:, None] * r
+    xs = tpo[:, None] + (tpo[nxt] - tpo)[:, None] * curve
+
+    # Linear segments only need their start point
+    keep = np.zeros(times.shape, bool)
+    keep[:, 0] = True
+    keep[np.isin(air, AIR_BENDS), :] = True
+    keep[last, 1:] = False
+    return (times + slide[:, None] * span)[keep], xs[keep], span
+
 
 class SekaiGamer:
-    # Music notes data
-    taps: list[dict]
-    slides: list[list[dict]]
+    # Note columns are kept as plain lists: they are only indexed one element at a time in on_frame, where numpy
+    # scalars would be several times slower than python ints and floats.
+
+    # Taps (including air notes), sorted by time, with a cursor at the first tap not played yet
+    tap_t: list[int]
+    tap_tpo: list[float]
+    tap_tid: list[int]
+    tap_kind: list[int]
+    tap_i: int = 0
+
+    # Slides sorted by start time: start time, end time, touch x at both ends, air type of the last note, touch id
+    slide_t0: list[int]
+    slide_t1: list[int]
+    slide_x0: list[float]
+    slide_x1: list[float]
+    slide_air: list[int]
+    slide_tid: list[int]
+    slide_i: int = 0
+
+    # Slide paths (see slide_paths)
+    path_t: ndarray
+    path_x: ndarray
+    path_span: float
+
+    # Ongoing slides in fixed slots: index of the slide, or None if the slot is free
+    slots: list[int | None]
+    n_ongoing: int = 0
 
     # In-game time in nanoseconds
     igt: int = 0
     started: bool = False
     done: bool = False
+    done_at: int = 0  # When the chart was done (ns)
+    # Simulated playback (see simulate.py): don't save the start frame or exit the process when done
+    offline: bool = False
 
-    # Queue of air notes to be flicked (start ela time, lane, touch_id)
-    air_queue: list[tuple[int, int, int]] = []
-    slide_ongoing: list[list[dict]] = []
     y = dev.touch_y
 
     # Late: decrease, Fast: increase
     late_early_total = 0
     late_early_last_adjust = 0
 
-    def __init__(self, client: Client, notes: dict):
+    # Frame time (ns) at which the first note's leading edge was first seen on each visual line
+    start_lines: dict[int, int]
+    # Estimated time (ns) at which the first note reaches the judgement line
+    start_hit: float = 0
+
+    def __init__(self, client: Client, notes: ndarray, max_slides: int = 16):
+        """
+        :param client: The scrcpy client
+        :param notes: The note array of the chart (see chart.load_chart)
+        :param max_slides: Maximum number of slides held at the same time
+        """
         self.client = client
-        self.taps, self.slides = notes['taps'], notes['slides']
-
-        def norm_lane(t):
-            lane = t['lane'] - 2
-            t['tpo'] = (touch_positions[lane] + touch_positions[lane + t['width']]) / 2
-            # if t['r'] == 'air' or (t.get('airNote') and t['airNote'].get('type') == 'flick'):
-                # t['t'] -= air_time_delta / 2
-
-        [norm_lane(t) for t in self.taps]
-        [norm_lane(t) for s in self.slides for t in s]
+        self.start_lines = {}
+
+        taps = notes[notes['slide'] < 0]
+        taps = taps[np.argsort(taps['t'], kind='stable')]
+        self.tap_t, self.tap_tid, self.tap_kind = taps['t'].tolist(), taps['tid'].tolist(), taps['kind'].tolist()
+        self.tap_tpo = taps['tpo'].astype(np.float64).tolist()
+
+        # Split slide notes into slides (the notes of a slide are stored together, in time order), then sort the
+        # slides by their start time
+        sn = notes[notes['slide'] >= 0]
+        starts = np.flatnonzero(np.diff(sn['slide'], prepend=-2))
+        lengths = np.diff(starts, append=len(sn))
+        start_t = sn['t'][starts]
+        sn = sn[np.argsort(np.repeat(start_t, lengths), kind='stable')]
+        lengths = lengths[np.argsort(start_t, kind='stable')]
+        first, last = np.cumsum(lengths) - lengths, np.cumsum(lengths) - 1
+        self.slide_t0, self.slide_t1 = sn['t'][first].tolist(), sn['t'][last].tolist()
+        self.slide_x0 = sn['tpo'][first].astype(np.float64).tolist()
+        self.slide_x1 = sn['tpo'][last].astype(np.float64).tolist()
+        self.slide_air, self.slide_tid = sn['air'][last].tolist(), sn['tid'][first].tolist()
+        self.path_t, self.path_x, self.path_span = slide_paths(
+            sn['t'].astype(np.float64), sn['tpo'].astype(np.float64), sn['air'], lengths)
+
+        self.slots = [None] * max_slides
+        self.flicks = FlickQueue()
+        self.touches = TouchBatch(client)
+        # Device serial, which timing offsets are saved under
+        self.serial = str(client.device.serial if hasattr(client, 'device') else dev.adb_serial)
+        saved = 0 if self.offline else load_offset(self.serial)
+        self.calib = TimingCalibrator(saved, calib_saved_var if saved else calib_init_var)
 
     def touch(self, x: int | float, y: int | float, action: int, tid: int):
-        self.client.control.touch(int(round(x)), int(round(y)), action, tid)
+        """ Queue a touch event (in screen pixels), sent at the end of the current play() call """
+        self.touches.add(*stream.point(x, y), action, tid)
 
     def adjust(self, is_fast: bool, is_late: bool) -> None:
-        """ Adjust fast or late by diff ms """
-        diff = [0, -1, 1][is_late * 1 + is_fast * 2] * late_early_ms
-        self.igt += diff * 1_000_000
+        """ Feed a fast/late judgement to the calibrator and shift igt by the change of its offset """
+        diff = self.calib.observe(is_fast, is_late)
+        self.igt += int(diff * 1_000_000)
         self.late_early_total += diff
         self.late_early_last_adjust = int(time.time_ns() - self.igt) / 1_000_000
-        diff != 0 and printc(f'{'&cLate: -' if is_late else '&bFast: +'}{abs(diff)} ms')
-
-    def find_start(self, frame: ndarray) -> None:
-        """ Find if we're ready to start """
-        gray: ndarray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).T
-
-        # Find if one match is found
-        points = gray[ys[1]] > light_threshold
-        if not np.any(points):
+        diff != 0 and printc(f'{'&cLate: -' if is_late else '&bFast: +'}{abs(diff):.2f} ms')
+
+    def first_note_t(self) -> int:
+        """ Time of the first note in the chart (ms) """
+        return min(self.tap_t[:1] + self.slide_t0[:1], default=0)
+
+    def find_start(self, frame: ndarray, now: int) -> None:
+        """
+        Track the first note while it falls through the visual lines. Every line it reaches gives one estimate of when
+        it will be hit (frame time + the line's delay). Their mean is the least-squares fit of the note's trajectory,
+        which averages out the frame interval quantization of each single estimate.
+
+        :param frame: The BGR frame
+        :param now: Time (ns) at which the frame was received
+        """
+        bright = frame[grid_y, grid_x] @ gray_weights > light_threshold
+        if not bright.any():
             return
 
-        # Find index where the first match is found
-        first = np.argmax(points, axis=0)
-        y = ys[0][first][1]
-        delay = ys[3][ys[2].index(y)]
+        # The leading (lowest) edge of the first note
+        line = int(grid_line[bright].max())
+        if line in self.start_lines:
+            return
+        hit = now + line_delay[line] * 1_000_000
+        if self.start_lines and abs(hit - self.start_hit) > start_track_tol * 1_000_000:
+            return
+        self.start_lines[line] = now
+        self.start_hit = np.mean([t + line_delay[i] * 1_000_000 for i, t in self.start_lines.items()])
 
-        # Start
+        # Remove the first note's start time from igt, and apply the offset learned in previous plays
+        self.igt = int(self.start_hit) - self.first_note_t() * 1_000_000 + int(self.calib.offset * 1_000_000)
+        if self.started:
+            return
         self.started = True
-        self.igt = int(time.time_ns() + delay * 1_000_000)
-
-        # Remove the first note's start time from igt
-        self.igt -= min(self.taps[0]['t'], self.slides[0][0]['t']) * 1_000_000
+        threading.Thread(target=self.run, name='gamer', daemon=True).start()
 
         print("Playing")
-        # For debug: draw a line on the visual line and save the frame
-        gray[ys[1]] = 255
-        date = time.strftime("%Y%m%d-%H%M%S")
-        get_log_path().mkdir(exist_ok=True)
-        cv2.imwrite(str(get_log_path() / f"{date}.webp"), gray.T)
+        if self.offline:
+            return
+        # For debug: mark the sampled points and save the frame
+        debug = frame.copy()
+        debug[grid_y, grid_x] = 255
+        util.image_writer.write(get_log_path() / f"{time.strftime("%Y%m%d-%H%M%S")}.webp", debug)
 
     def on_frame(self, frame: ndarray) -> None:
-        # Elapsed ms since the start
-        ela = int((time.time_ns() - self.igt) / 1_000_000)
-        if ela < 0 or frame is None or self.done:
+        """
+        Frames are only used to detect the start and fast/late judgements, notes are played by the playback thread
+        """
+        now = time.time_ns()
+        if frame is None or self.done:
             return
 
-        # Hasn't started yet
-        if not self.started:
-            self.find_start(frame)
+        # Refine the start until the first note is played
+        if not self.started or (self.tap_i == 0 and self.slide_i == 0 and len(self.start_lines) < len(line_ys)):
+            self.find_start(frame, now)
+
+        # Elapsed ms since the start
+        ela = int((now - self.igt) / 1_000_000)
+        if not self.started or ela < 0:
             return
 
         # Detect late/early (in-between delay 0.3s)
@@ -147,89 +462,119 @@ class SekaiGamer:
             color = frame[late_early_px[1], late_early_px[0]]
             self.adjust(np.linalg.norm(color - fast) < 30, np.linalg.norm(color - late) < 30)
 
-        # Pop any note that is ready to be played
-        todo = []
-        while self.taps and self.taps[0]['t'] < ela:
-            todo.append(self.taps.pop(0))
+    def next_wake(self, ela: float) -> float:
+        """
+        Elapsed time (ms) at which the playback thread should call play next
+        """
+        due = [ela + play_max_sleep_ms]
+        if self.tap_i < len(self.tap_t):
+            due.append(self.tap_t[self.tap_i])
+        if self.slide_i < len(self.slide_t0):
+            due.append(self.slide_t0[self.slide_i])
+        if self.n_ongoing or self.flicks.size:
+            due.append(ela + play_tick_ms)
+        return min(due)
+
+    def run(self) -> None:
+        """
+        The playback thread: plays notes at their scheduled time, independent of when frames arrive
+        """
+        while not self.done:
+            # Read igt once, on_frame may adjust it at any time
+            igt = self.igt
+            ela = (time.time_ns() - igt) / 1_000_000
+            if ela >= 0:
+                self.play(ela)
+            util.sleep_until(igt + int(self.next_wake(ela) * 1_000_000))
+
+    def slide_x(self, slides: list[int], ela: float) -> ndarray:
+        """
+        Touch x positions of slides at an elapsed time
+
+        :param slides: Slide indices
+        :param ela: Elapsed ms since the start of the chart, within the slides' time ranges
+        :return: Touch x of each slide
+        """
+        return np.interp(np.array(slides) * self.path_span + ela, self.path_t, self.path_x)
+
+    def play(self, ela: float) -> None:
+        """
+        Emit all touches due at the given elapsed time
+
+        :param ela: Elapsed ms since the start of the chart (not rounded, so notes play at sub-ms precision)
+        """
+        # Move the cursor past every tap that is ready to be played
+        tap_from = self.tap_i
+        self.tap_i = bisect.bisect_left(self.tap_t, ela, tap_from)
 
         # Flick air notes
-        for t in list(self.air_queue):
-            end, tpo, tid = t
-            # Check if it's done
-            if end < ela:
-                self.touch(tpo, self.y - air_delta, ACTION_UP, tid)
-                self.air_queue.remove(t)
-                continue
+        fq = self.flicks
+        for tpo, tid in fq.expire(ela) if fq.size else ():
+            self.touch(tpo, self.y - air_delta, ACTION_UP, tid)
+        for i in fq.indices():
+            end, tpo, tid = fq.end[i], fq.tpo[i], fq.tid[i]
             # Interpolate the position
-            y = self.y - air_delta + (self.y - air_delta - self.y) * (ela - t[0]) / air_time_delta
+            y = self.y - air_delta + (self.y - air_delta - self.y) * (ela - end) / air_time_delta
             self.touch(tpo, y, ACTION_MOVE, tid)
 
         # Play the notes
-        for t in todo:
-            tid, tpo = t['tid'], t['tpo']
-            if t['r'] == 'short':
+        for i in range(tap_from, self.tap_i):
+            tid, tpo, kind = self.tap_tid[i], self.tap_tpo[i], self.tap_kind[i]
+            if kind == KIND_SHORT:
                 self.touch(tpo, self.y, ACTION_DOWN, tid)
                 self.touch(tpo, self.y, ACTION_UP, tid)
-            elif t['r'] == 'air':
+            elif kind == KIND_AIR:
                 self.touch(tpo, self.y, ACTION_DOWN, tid)
-                self.air_queue.append((ela + air_time_delta, tpo, tid))
+                fq.push(ela + air_time_delta, tpo, tid)
             else:
-                print("Unknown note type", t)
-
-        # Ongoing slides: move to interpolated position
-        for slide in list(self.slide_ongoing):
-            tid = slide[0]['tid']
-            if len(slide) == 1:
-                # If we're ready to finish
-                t = slide[0]
-                if t['t'] < ela:
-                    tid, tpo = t['tid'], t['tpo']
-                    if t.get('airNote') and t['airNote'].get('type') == 'flick':
-                        # Add to flick queue
-                        self.air_queue.append((ela + air_time_delta, tpo, tid))
-                    else:
-                        self.touch(tpo, self.y, ACTION_UP, tid)
-                    self.slide_ongoing.remove(slide)
-                continue
+                print("Unknown note type", kind)
 
-            t_from, t_to = slide[0], slide[1]
-            po_from, po_to = t_from['tpo'], t_to['tpo']
-            # If we're ready to move to the next note
-            if t_to['t'] < ela:
-                slide.pop(0)
-                self.touch(po_to, self.y, ACTION_MOVE, tid)
+        # Ongoing slides: finish the ones past their last note, and move the others along their path
+        moving = []
+        for k, i in enumerate(self.slots) if self.n_ongoing else ():
+            if i is None:
                 continue
-
-            # Move to interpolated position
-            time_delta = t_to['t'] - t_from['t']
-            ratio = (ela - t_from['t']) / time_delta
-            po_diff = po_to - po_from
-            # Check if it's linear or sin
-            if t_from.get('airNote') and 'bend' in t_from['airNote'].get('type'):
-                if t_from['airNote']['type'] == 'slide bend middle':
-                    po = po_diff * (1 - math.sin(ratio * math.pi / 2 + math.pi / 2)) + po_from
+            if self.slide_t1[i] < ela:
+                if self.slide_air[i] == AIR_FLICK:
+                    # Add to flick queue
+                    fq.push(ela + air_time_delta, self.slide_x1[i], self.slide_tid[i])
                 else:
-                    po = po_diff * math.sin(ratio * math.pi / 2) + po_from
+                    self.touch(self.slide_x1[i], self.y, ACTION_UP, self.slide_tid[i])
+                self.slots[k] = None
+                self.n_ongoing -= 1
             else:
-                po = po_diff * ratio + po_from
-            self.touch(po, self.y, ACTION_MOVE, tid)
+                moving.append(i)
+        if moving:
+            for i, x in zip(moving, self.slide_x(moving, ela).tolist()):
+                self.touch(x, self.y, ACTION_MOVE, self.slide_tid[i])
 
         # Slides
-        while self.slides and self.slides[0][0]['t'] < ela:
-            slide = self.slides.pop(0)
-            self.slide_ongoing.append(slide)
+        while self.slide_i < len(self.slide_t0) and self.slide_t0[self.slide_i] < ela:
+            i = self.slide_i
+            self.slide_i += 1
+            if self.n_ongoing == len(self.slots):
+                printc(f"&cToo many ongoing slides, skipping slide {self.slide_tid[i]}")
+                continue
+            self.slots[self.slots.index(None)] = i
+            self.n_ongoing += 1
             # Press the first note
-            t = slide[0]
-            tid, tpo = t['tid'], t['tpo']
-            self.touch(tpo, self.y, ACTION_DOWN, tid)
-
-        # If everything is done, unset global_dict['playing']
-        if not self.taps and not self.slides and not self.slide_ongoing and not self.air_queue:
-            printc(f"&aDone! Total delay adjusted: {self.late_early_total} ms")
-            threading.Thread(target=exit_thread).start()
+            self.touch(self.slide_x0[i], self.y, ACTION_DOWN, self.slide_tid[i])
+
+        self.touches.flush()
+
+        # If everything is done, exit (or let the session go back to stage detection)
+        if self.tap_i == len(self.tap_t) and self.slide_i == len(self.slide_t0) \
+                and not self.n_ongoing and not fq.size:
+            self.offline or save_offset(self.serial, self.calib.offset)
+            printc(f"&aDone! Total delay adjusted: {self.late_early_total:.2f} ms, "
+                   f"learned offset: {self.calib.offset:.2f} ms | "
+                   f"Touch events sent: {self.touches.sent}, merged: {self.touches.merged}")
+            if exit_when_done and not self.offline:
+                threading.Thread(target=exit_thread).start()
+            self.done_at = time.time_ns()
             self.done = True
 
 
 def exit_thread():
-    time.sleep(5)
+    time.sleep(exit_delay)
     os._exit(0)
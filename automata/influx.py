@@ -13,6 +13,7 @@ from tqdm import tqdm
 
 from events.consts import ANALYZING_EVENT
 from .config import config
+from .templates import sources
 from .util import ImageFinder, ocr_extract_number
 
 HTTP = requests.Session()
@@ -51,7 +52,7 @@ def send(point: Point | list[Point] | list[dict]) -> None:
         client.close()
 
 
-OCR_RES = Path(__file__).parent / 'stages/editor-1080x536/ocr'
+OCR_RES = sources()[0][2] / 'ocr'
 all_fields = lambda x: [file.stem.split('_', 2)[-1] for file in OCR_RES.glob(f'result_{x}_*')]
 ifs = lambda x: {field: ImageFinder(f'ocr/result_{x}_{field}') for field in all_fields(x) if field != 'identify'}
 pairs = {
@@ -0,0 +1,195 @@
+"""
+Instrumentation for stage detection: how long each `is_stage` takes, how often it hits, and which transitions
+between stages were not expected. Also the CPU time that receiving and decoding the stream takes in each stream
+mode. Exposed in Prometheus text format and as InfluxDB points.
+"""
+import bisect
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+from .util import check_stats, image_writer
+
+# Latency histogram bucket upper bounds (seconds)
+buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+@dataclass
+class StageStats:
+    hits: int = 0
+    misses: int = 0
+    reused: int = 0  # Negative verdicts reused on an unchanged screen, without calling is_stage
+    total: float = 0  # Total is_stage time (seconds)
+    counts: list[int] = field(default_factory=lambda: [0] * (len(buckets) + 1))  # Last one is +Inf
+
+
+class StreamMetrics:
+    """
+    Per stream mode ('menu', 'play'): frames received, CPU time of the stream threads (decoding and the frame
+    callbacks), and time spent in the mode
+    """
+    def __init__(self):
+        self.frames = Counter()
+        self.cpu = Counter()  # Seconds
+        self.seconds = Counter()
+        self.switches = Counter()  # Mode switched to -> count
+        self.restart = Counter()  # Mode -> total seconds spent reconnecting to switch to it
+        self.lock = threading.Lock()
+
+    def frame(self, mode: str, cpu: float) -> None:
+        """ Record a frame and the stream thread CPU time (seconds) since the previous one """
+        with self.lock:
+            self.frames[mode] += 1
+            self.cpu[mode] += cpu
+
+    def left(self, mode: str, seconds: float) -> None:
+        """ Record how long a device stayed in a mode """
+        with self.lock:
+            self.seconds[mode] += seconds
+
+    def switch(self, mode: str, seconds: float) -> None:
+        """ Record a switch to a mode and how long reconnecting took """
+        with self.lock:
+            self.switches[mode] += 1
+            self.restart[mode] += seconds
+
+
+class StageMetrics:
+    stages: dict[str, StageStats]
+    transitions: Counter  # (from, to, expected) -> count
+
+    def __init__(self):
+        self.stages = {}
+        self.transitions = Counter()
+        self.lock = threading.Lock()
+
+    def _stats(self, stage: str) -> StageStats:
+        if stage not in self.stages:
+            self.stages[stage] = StageStats()
+        return self.stages[stage]
+
+    def record(self, stage: str, seconds: float, hit: bool) -> None:
+        """
+        Record one is_stage call
+
+        :param stage: The stage name
+        :param seconds: How long is_stage took
+        :param hit: Whether it returned True
+        """
+        with self.lock:
+            s = self._stats(stage)
+            s.total += seconds
+            s.counts[bisect.bisect_left(buckets, seconds)] += 1
+            if hit:
+                s.hits += 1
+            else:
+                s.misses += 1
+
+    def avg_seconds(self, stage: str) -> float | None:
+        """ Average is_stage time of a stage, None if it was never called """
+        s = self.stages.get(stage)
+        if s and s.hits + s.misses:
+            return s.total / (s.hits + s.misses)
+
+    def reuse(self, stage: str) -> None:
+        """ Record a reused negative verdict """
+        with self.lock:
+            self._stats(stage).reused += 1
+
+    def transition(self, prev: str | None, stage: str, expected: bool) -> None:
+        """
+        Record that a stage was found
+
+        :param prev: The previously found stage
+        :param stage: The stage found now
+        :param expected: Whether the stage was in the expected next stages of the last operation
+        """
+        with self.lock:
+            self.transitions[(prev or 'none', stage, expected)] += 1
+
+    def prometheus(self) -> str:
+        """
+        Render all metrics in Prometheus text format
+        """
+        out = [
+            '# HELP sekai_stage_check_seconds Time spent in is_stage',
+            '# TYPE sekai_stage_check_seconds histogram',
+        ]
+        with self.lock:
+            for name, s in sorted(self.stages.items()):
+                cum = 0
+                for le, c in zip([*buckets, '+Inf'], s.counts):
+                    cum += c
+                    out.append(f'sekai_stage_check_seconds_bucket{{stage="{name}",le="{le}"}} {cum}')
+                out.append(f'sekai_stage_check_seconds_sum{{stage="{name}"}} {s.total}')
+                out.append(f'sekai_stage_check_seconds_count{{stage="{name}"}} {cum}')
+
+            out += ['# HELP sekai_stage_checks_total Stage checks by result',
+                    '# TYPE sekai_stage_checks_total counter']
+            for name, s in sorted(self.stages.items()):
+                for result, c in (('hit', s.hits), ('miss', s.misses), ('reused', s.reused)):
+                    out.append(f'sekai_stage_checks_total{{stage="{name}",result="{result}"}} {c}')
+
+            out += ['# HELP sekai_stage_transitions_total Stages found, by the previous stage',
+                    '# TYPE sekai_stage_transitions_total counter']
+            for (prev, stage, expected), c in sorted(self.transitions.items()):
+                out.append(f'sekai_stage_transitions_total{{from="{prev}",to="{stage}",'
+                           f'expected="{str(expected).lower()}"}} {c}')
+
+        out += ['# HELP sekai_image_checks_total ImageFinder checks, including early rejections',
+                '# TYPE sekai_image_checks_total counter']
+        for k, v in sorted(check_stats.items()):
+            out.append(f'sekai_image_checks_total{{result="{k}"}} {v}')
+
+        out += ['# HELP sekai_image_writer_queue_depth Images waiting to be saved',
+                '# TYPE sekai_image_writer_queue_depth gauge',
+                f'sekai_image_writer_queue_depth {image_writer.depth()}',
+                '# HELP sekai_image_writer_total Images handled by the background writer',
+                '# TYPE sekai_image_writer_total counter']
+        for k in ('written', 'dropped', 'failed'):
+            out.append(f'sekai_image_writer_total{{result="{k}"}} {image_writer.stats[k]}')
+
+        sm = stream_metrics
+        with sm.lock:
+            for name, kind, desc, values in (
+                    ('frames_total', 'counter', 'Stream frames received', sm.frames),
+                    ('cpu_seconds_total', 'counter', 'CPU time of the stream threads (decoding and callbacks)', sm.cpu),
+                    ('mode_seconds_total', 'counter', 'Time spent in each stream mode (up to the last switch)',
+                     sm.seconds),
+                    ('switches_total', 'counter', 'Stream mode switches', sm.switches),
+                    ('restart_seconds_total', 'counter', 'Time spent reconnecting the stream to switch modes',
+                     sm.restart)):
+                out += [f'# HELP sekai_stream_{name} {desc}', f'# TYPE sekai_stream_{name} {kind}']
+                out += [f'sekai_stream_{name}{{mode="{m}"}} {v}' for m, v in sorted(values.items())]
+        return '\n'.join(out) + '\n'
+
+    def points(self) -> list[dict]:
+        """
+        Snapshot the per-stage metrics as InfluxDB points (see influx.send)
+        """
+        now = time.time_ns()
+        with self.lock:
+            unexpected = Counter()
+            for (_, stage, expected), c in self.transitions.items():
+                if not expected:
+                    unexpected[stage] += c
+            points = [{"measurement": "stage_detection", "tags": {"stage": name}, "time": now, "fields": {
+                "hits": s.hits, "misses": s.misses, "reused": s.reused, "unexpected": unexpected[name],
+                "avg_ms": s.total / max(s.hits + s.misses, 1) * 1000,
+            }} for name, s in self.stages.items()]
+        points.append({"measurement": "image_writer", "time": now, "fields": {
+            "queue_depth": image_writer.depth(), **{k: image_writer.stats[k] for k in ('written', 'dropped', 'failed')},
+        }})
+        with stream_metrics.lock:
+            sm = stream_metrics
+            points += [{"measurement": "stream", "tags": {"mode": mode}, "time": now, "fields": {
+                "frames": sm.frames[mode], "cpu_s": sm.cpu[mode], "seconds": sm.seconds[mode],
+                "switches": sm.switches[mode], "restart_s": sm.restart[mode],
+                "cpu_ms_per_frame": sm.cpu[mode] / max(sm.frames[mode], 1) * 1000,
+            }} for mode in sm.frames | sm.switches]
+        return points
+
+
+stage_metrics = StageMetrics()
+stream_metrics = StreamMetrics()
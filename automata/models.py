@@ -1,14 +1,27 @@
 import random
 import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import cv2
+import numpy as np
 import scrcpy
 from numpy import ndarray
 
 from automata.config import get_log_path
+from automata.util import image_writer
+
+if TYPE_CHECKING:
+    from automata.gamer import SekaiGamer
+
+# A pixel counts as changed when its gray level differs by more than this
+frame_diff_threshold = 24
+# A frame counts as changed when more than this fraction of the pixels in any watched region (the template rect of
+# each image finder) changed. On the template previews, at 1080x536 and 540x268 alike, re-encoding as JPEG q80
+# changes at most 1.3% of any rect, while filling a template with a flat color changes 6% of its rect or more.
+frame_diff_fraction = 0.03
 
 
 class Action(ABC):
@@ -58,27 +71,105 @@ class SekaiStageContext:
     time: int  # Current time in milliseconds when the frame was captured
     last_op: SekaiStageOp
     last_op_done: int | None = 1  # Time when the last operation was completed, if it is completed
-    frame_gray: ndarray = None
+    last_stage: str | None = None  # Name of the last stage found
+    rois: list[tuple[slice, slice]] | None = None  # Regions to convert to grayscale, None for the full frame
+    # (index in rois, y slice, x slice inside that roi) of each region whose change counts, None for the whole rois
+    watch: list[tuple[int, slice, slice]] | None = None
+    frame_sig: list[ndarray] | None = None  # Gray pixels of each roi in the frame that frame_gray was computed from
+    frame_changed: bool = True  # Whether the screen changed since the last frame
+    verdicts: dict[str, bool] = field(default_factory=dict)  # Last is_stage result per stage on the current screen
+    check_order: list[str] | None = None  # Order find_stage last checked the unexpected stages in
+    playing: 'SekaiGamer | None' = None  # The gamer while a song is played, frames go to it instead
+    _frame_gray: ndarray = field(default=None, repr=False)
+    _gray_buf: ndarray = field(default=None, repr=False)
+
+    @property
+    def frame_gray(self) -> ndarray:
+        """
+        The grayscale frame, assembled lazily once per changed frame from the pixels that next() compared. When rois
+        is set, only those regions are converted and every pixel outside them is black.
+        """
+        if self._frame_gray is None:
+            # Converted already to compare frames, unless the context was made without next()
+            if self.frame_sig is None:
+                self.frame_sig = self._signature(self.frame)
+            if self.rois is None:
+                self._frame_gray = self.frame_sig[0]
+            else:
+                if self._gray_buf is None or self._gray_buf.shape != self.frame.shape[:2]:
+                    self._gray_buf = np.zeros(self.frame.shape[:2], np.uint8)
+                for r, g in zip(self.rois, self.frame_sig):
+                    self._gray_buf[r] = g
+                self._frame_gray = self._gray_buf
+        return self._frame_gray
 
     def tap(self, x: int, y: int):
         id = random.randint(0, 500)
         self.client.control.touch(x, y, scrcpy.ACTION_DOWN, id)
         self.client.control.touch(x, y, scrcpy.ACTION_UP, id)
+        self.invalidate()
 
-    def next(self, frame: ndarray):
+    def next(self, frame: ndarray, time_ns: int | None = None):
+        """
+        :param frame: The new frame
+        :param time_ns: When the frame was received, now by default
+        """
         self.cache.clear()
         self.frame = frame
-        self.frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        self.time = time.time_ns() // 1_000_000
+        self.time = (time_ns or time.time_ns()) // 1_000_000
+
+        # Compare with the last changed frame, so that slow fades still add up to a change
+        sig = self._signature(frame)
+        self.frame_changed = self.frame_sig is None or [g.shape for g in sig] != [g.shape for g in self.frame_sig] \
+            or self._changed(sig)
+        if self.frame_changed:
+            self._reset(sig)
+
+    def _changed(self, sig: list[ndarray]) -> bool:
+        # Fractions per region, so that a small button counts as much as a large one at any stream size
+        masks = [cv2.compare(cv2.absdiff(a, b), frame_diff_threshold, cv2.CMP_GT) for a, b in zip(sig, self.frame_sig)]
+        for i, ys, xs in self.watch or [(i, slice(None), slice(None)) for i in range(len(sig))]:
+            m = masks[i][ys, xs]
+            if cv2.countNonZero(m) > frame_diff_fraction * m.size:
+                return True
+        return False
+
+    def _signature(self, frame: ndarray) -> list[ndarray]:
+        # Only the pixels that stages read (all of them without rois)
+        return [cv2.cvtColor(frame[r], cv2.COLOR_BGR2GRAY) for r in self.rois] if self.rois is not None \
+            else [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)]
+
+    def _reset(self, sig: list[ndarray]):
+        self.frame_sig = sig
+        self._frame_gray = None
+        self.verdicts.clear()
+
+    def refresh(self):
+        """
+        Forget the stage verdicts and read the current frame again, even if it counts as unchanged. Changes below
+        frame_diff_fraction can't hide a stage for longer than the interval between refreshes.
+        """
+        self._reset(self._signature(self.frame))
+
+    def invalidate(self):
+        """
+        Forget the stage verdicts and treat the next frame as changed. Call this after acting on the device.
+        """
+        self.frame_sig = None
+        self.verdicts.clear()
 
     def save(self):
         # Save an image screenshot
         date = time.strftime("%Y%m%d-%H%M%S")
-        get_log_path().mkdir(exist_ok=True)
-        cv2.imwrite(str(get_log_path() / f"{date}.webp"), self.frame)
+        image_writer.write(get_log_path() / f"{date}.webp", self.frame)
 
 
 class SekaiStage(ABC):
+    # Whether is_stage only depends on the frame, so a negative verdict can be reused while the screen is unchanged
+    frame_only: bool = True
+    # Stream mode ('menu' or 'play', see Session.set_mode) the device switches to when this stage is entered
+    stream_mode: str = 'menu'
+
     def __init__(self, name: str):
         self.name = name
 
@@ -0,0 +1,357 @@
+"""
+Frame recording and deterministic replay
+
+With config.record_frames, every session saves the frames its decision loop processed (JPEG, appended to
+`frames.bin` and indexed by capture time in `index.bin`) and the stages it entered, the operations it performed,
+the order it checked unexpected stages in, every control message it sent and the frames the recorder had to drop
+(`events.jsonl`), under `{log path}/record/{serial}-{date}`. Frames that the loop saw as unchanged are not encoded
+again, their index entries point to the last changed frame.
+
+`python -m automata.record <dir>` feeds a recording through Session.process and find_next with a fake client, as fast
+as possible or paced like the recording. Stage detection only sees the recorded capture times, and checks stages in
+the recorded order (which live depends on measured check times), so a replay makes the same decisions at any speed:
+a repeatable benchmark of stage detection that needs no phone. Touches played by the gamer are recorded but not
+replayed, song frames aren't recorded.
+"""
+import argparse
+import bisect
+import json
+import re
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from pathlib import Path
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from .config import config, get_log_path, log
+from .coords import stream_size
+from .stage import StageScheduler
+from .util import sleep_until
+
+index_dtype = np.dtype([
+    ('time', '<i8'),  # Capture time (ns)
+    ('offset', '<u8'),  # Offset of the encoded frame in frames.bin
+    ('size', '<u4'),
+])
+jpeg_quality = 95
+
+
+class EventLog:
+    """
+    Events of a session (stages entered, operations, control messages), kept in memory
+    """
+    def __init__(self):
+        self.events: list[dict] = []
+
+    def event(self, kind: str, **data) -> None:
+        """
+        Record an event
+
+        :param kind: 'stage', 'op' or 'control'
+        :param data: Anything JSON serializable
+        """
+        self.events.append({'t': time.time_ns(), 'kind': kind, **data})
+
+    def frame(self, frame: ndarray, time_ns: int, changed: bool = True) -> None:
+        pass
+
+
+class Recorder(EventLog):
+    """
+    Saves the frames and events of a session to a directory. Frames and events are encoded and written on a background
+    thread, so that callers (e.g. the gamer's touches) never wait for the disk. Frames have a bounded queue: when the
+    disk can't keep up, the oldest pending frames are dropped, and a 'dropped' event records their capture time.
+    """
+    def __init__(self, path: Path, serial: str, queue: int = 32):
+        super().__init__()
+        self.path = path
+        path.mkdir(parents=True, exist_ok=True)
+        (path / 'meta.json').write_text(json.dumps({
+            'serial': serial, 'screen_size': config.device.screen_size, 'stream_size': stream_size,
+            'fps': config.device.fps,
+            'created': time.time_ns()}), 'utf-8')
+        self.frames_file = (path / 'frames.bin').open('ab')
+        self.index_file = (path / 'index.bin').open('ab')
+        self.events_file = (path / 'events.jsonl').open('a', encoding='utf-8')
+        self.offset = self.frames_file.tell()
+        self.queue: deque[tuple[ndarray | None, int]] = deque(maxlen=queue)
+        self.pending: list[dict] = []  # Events not written yet
+        self.last: tuple[int, int] | None = None  # (offset, size) of the last frame written
+        self.cond = threading.Condition()
+        self.stats: Counter = Counter()  # 'recorded', 'repeated', 'dropped'
+        threading.Thread(target=self._work, name=f'recorder-{serial}', daemon=True).start()
+
+    @classmethod
+    def for_serial(cls, serial: str) -> 'Recorder':
+        """ Start a new recording of a device in the log directory """
+        name = f"{re.sub(r'[^\w.-]', '_', serial)}-{time.strftime('%Y%m%d-%H%M%S')}"
+        return cls(get_log_path() / 'record' / name, serial)
+
+    def event(self, kind: str, **data) -> None:
+        with self.cond:
+            self.pending.append({'t': time.time_ns(), 'kind': kind, **data})
+            self.cond.notify()
+
+    def frame(self, frame: ndarray, time_ns: int, changed: bool = True) -> None:
+        """
+        Queue a frame to be saved. The frame must not be modified afterwards.
+
+        :param frame: The frame
+        :param time_ns: Capture time of the frame
+        :param changed: False to save a reference to the last frame instead
+        """
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.stats['dropped'] += 1
+                self.pending.append({'t': time.time_ns(), 'kind': 'dropped', 'time': self.queue[0][1]})
+            self.queue.append((frame if changed else None, time_ns))
+            self.cond.notify()
+
+    def _work(self) -> None:
+        while True:
+            with self.cond:
+                while not self.queue and not self.pending:
+                    self.cond.wait()
+                events, self.pending = self.pending, []
+                frame, time_ns = self.queue.popleft() if self.queue else (None, None)
+            if events:
+                self.events_file.write(''.join(json.dumps(e) + '\n' for e in events))
+                self.events_file.flush()
+            if time_ns is None:
+                continue
+            if frame is not None:
+                ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+                if not ok:
+                    continue
+                # The frame goes first, so that the index never points past the end of frames.bin
+                self.frames_file.write(buf.tobytes())
+                self.frames_file.flush()
+                self.last = (self.offset, len(buf))
+                self.offset += len(buf)
+            elif self.last is None:
+                continue
+            self.index_file.write(np.array([(time_ns, *self.last)], index_dtype).tobytes())
+            self.index_file.flush()
+            self.stats['recorded' if frame is not None else 'repeated'] += 1
+
+
+class RecordingControl:
+    """
+    Wraps a scrcpy control sender and logs every message sent through it
+    """
+    def __init__(self, control, log: EventLog):
+        self._control = control
+        self._log = log
+
+    def __getattr__(self, name: str):
+        fn = getattr(self._control, name)
+        if not callable(fn):
+            return fn
+
+        def send(*args):
+            self.log_call(name, *args)
+            return fn(*args)
+        return send
+
+    def log_call(self, name: str, *args, **data) -> None:
+        """
+        Log a message, for messages sent to the control socket directly (e.g. TouchBatch)
+
+        :param name: The ControlSender method that builds the message
+        :param args: Its arguments
+        :param data: Extra fields of the event
+        """
+        self._log.event('control', name=name, args=[a if isinstance(a, (int, float, str)) else repr(a)
+                                                   for a in args], **data)
+
+
+class Recording:
+    """
+    A recording directory, opened for reading
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.meta = json.loads((path / 'meta.json').read_text('utf-8'))
+        # A session that was killed may have left half an index record
+        raw = (path / 'index.bin').read_bytes()
+        self.index = np.frombuffer(raw[:len(raw) // index_dtype.itemsize * index_dtype.itemsize], index_dtype)
+        self.data = np.memmap(path / 'frames.bin', np.uint8, 'r') if len(self.index) else np.zeros(0, np.uint8)
+        self.events = [json.loads(line) for line in (path / 'events.jsonl').read_text('utf-8').splitlines()
+                       if line.strip()]
+        self.decoded: tuple[int, ndarray] | None = None  # (offset, frame) of the last frame decoded
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def frame(self, i: int) -> ndarray:
+        """ Decode the i-th frame. Repeated frames are decoded once and returned as the same array. """
+        r = self.index[i]
+        if not self.decoded or self.decoded[0] != r['offset']:
+            self.decoded = (r['offset'], cv2.imdecode(self.data[r['offset']:r['offset'] + r['size']], cv2.IMREAD_COLOR))
+        return self.decoded[1]
+
+    def stages(self) -> list[str]:
+        """ Names of the stages entered, in order """
+        return [e['name'] for e in self.events if e['kind'] == 'stage']
+
+    def controls(self) -> int:
+        """ Number of control messages sent by stage operations (not the gamer's batched touches) """
+        return sum(e['kind'] == 'control' and not e.get('batch') for e in self.events)
+
+    def dropped(self) -> int:
+        """ Number of frames the recorder dropped because the disk couldn't keep up """
+        return sum(e['kind'] == 'dropped' for e in self.events)
+
+
+class ReplayScheduler(StageScheduler):
+    """
+    Orders the unexpected stages the way the recorded session did at the same frame. Recordings without orders fall
+    back to the learned order with a fixed check cost, so that the replay's own timing can't change it.
+    """
+    def __init__(self, rec: Recording):
+        super().__init__(None)
+        orders = [e for e in rec.events if e['kind'] == 'order']
+        self.times = [e['time'] for e in orders]
+        self.orders = [e['names'] for e in orders]
+        self.time = 0  # Capture time of the frame being replayed (ms)
+
+    def cost(self, stage: str) -> float:
+        return self.default_cost
+
+    def order(self, prev: str | None, names: set[str]) -> list[str]:
+        # Orders are recorded when they change, the last one up to this frame is the one used here
+        i = bisect.bisect_right(self.times, self.time) - 1
+        if i >= 0 and set(self.orders[i]) == names:
+            return self.orders[i]
+        return super().order(prev, names)
+
+
+class ReplayDevice:
+    def __init__(self, serial: str):
+        self.serial = serial
+
+    def shell(self, cmd: str) -> None:
+        log.info(f"[REPLAY] Skipped shell command: {cmd}")
+
+
+class ReplayControl:
+    """ Accepts every control message and sends nothing """
+    def __getattr__(self, name: str):
+        return lambda *args: None
+
+
+class ReplayClient:
+    """ Stands in for scrcpy.Client in a replay """
+    control_socket = None
+
+    def __init__(self, serial: str):
+        self.device = ReplayDevice(serial)
+        self.control = ReplayControl()
+
+
+@dataclass
+class ReplayResult:
+    frames: int
+    seconds: float  # Wall time of the replay
+    recorded_seconds: float  # Time span of the recording
+    decode_us: ndarray  # Frame decode time of each frame (us)
+    loop_us: ndarray  # process + find_next time of each frame (us)
+    stages: list[str]  # Stages entered in the replay
+    expected: list[str]  # Stages entered in the recording
+    controls: int  # Control messages sent by stage operations in the replay
+    expected_controls: int
+    dropped: int  # Frames dropped while recording, the replay didn't see them
+
+    def diverged_at(self) -> int | None:
+        """ Index of the first stage that differs from the recording, None if they are the same """
+        for i, (a, b) in enumerate(zip(self.stages, self.expected)):
+            if a != b:
+                return i
+        if len(self.stages) != len(self.expected):
+            return min(len(self.stages), len(self.expected))
+
+    def summary(self) -> str:
+        div = self.diverged_at()
+        return (f"{self.frames} frames ({self.recorded_seconds:.1f}s recorded) in {self.seconds:.2f}s: "
+                f"{self.frames / max(self.seconds, 1e-9):.0f} frames/s | "
+                f"loop p50 {np.median(self.loop_us):.0f} us, p99 {np.percentile(self.loop_us, 99):.0f} us, "
+                f"max {self.loop_us.max():.0f} us | decode p50 {np.median(self.decode_us):.0f} us | "
+                f"stages {len(self.stages)}/{len(self.expected)}, controls {self.controls}/{self.expected_controls} | "
+                + (f"{self.dropped} frames dropped while recording | " if self.dropped else "")
+                + ("same decisions" if div is None else
+                   f"diverged at stage #{div}: {self.stages[div:div + 1]} != {self.expected[div:div + 1]}"))
+
+
+def replay(rec: Recording, speed: float = 0) -> ReplayResult:
+    """
+    Feed a recording through a session's decision loop
+
+    :param rec: The recording
+    :param speed: Pace the frames at this multiple of the recorded speed, 0 for as fast as possible
+    :return: The result
+    """
+    from . import __main__ as main, gamer, stage
+
+    if not getattr(main, 'stages', None):
+        main.stages = stage.load_stages()
+    # Check unexpected stages in the recorded order, learned transitions and check times would change it
+    stage.scheduler = scheduler = ReplayScheduler(rec)
+    gamer.exit_when_done = False
+
+    events = EventLog()
+    session = main.Session(rec.meta['serial'], ReplayClient(rec.meta['serial']))
+    session.recorder = events
+    session.client.control = RecordingControl(session.client.control, events)
+    ctx = session.ctx
+    if not len(rec):
+        raise ValueError(f"{rec.path} has no frames")
+    t0 = int(rec.index['time'][0])
+    decode_ns, loop_ns = [], []
+
+    st = time.time_ns()
+    for i in range(len(rec)):
+        t = int(rec.index['time'][i])
+        if speed:
+            sleep_until(st + int((t - t0) / speed))
+        dt = time.perf_counter_ns()
+        frame = rec.frame(i)
+        dt = time.perf_counter_ns() - dt
+
+        # Frames of a song aren't recorded, the song is over by the next recorded frame
+        if ctx.playing:
+            ctx.playing = None
+            ctx.last_op_done = t // 1_000_000
+            ctx.invalidate()
+
+        scheduler.time = t // 1_000_000
+        lt = time.perf_counter_ns()
+        session.process(frame, t)
+        session.find_next()
+        loop_ns.append(time.perf_counter_ns() - lt)
+        decode_ns.append(dt)
+    seconds = (time.time_ns() - st) / 1e9
+
+    return ReplayResult(len(rec), seconds, (int(rec.index['time'][-1]) - t0) / 1e9,
+                        np.array(decode_ns) / 1000, np.array(loop_ns) / 1000,
+                        [e['name'] for e in events.events if e['kind'] == 'stage'], rec.stages(),
+                        sum(e['kind'] == 'control' and not e.get('batch') for e in events.events),
+                        rec.controls(), rec.dropped())
+
+
+if __name__ == '__main__':
+    from .metrics import stage_metrics
+
+    parser = argparse.ArgumentParser(description="Replay recorded frames through stage detection.")
+    parser.add_argument('recordings', nargs='+', type=Path, help='Recording directories')
+    parser.add_argument('--speed', type=float, default=0, help='Multiple of the recorded speed, 0 for max speed')
+    parser.add_argument('--metrics', action='store_true', help='Print stage detection metrics afterwards')
+    args = parser.parse_args()
+
+    for p in args.recordings:
+        print(f'{p}: {replay(Recording(p), args.speed).summary()}')
+    if args.metrics:
+        print(stage_metrics.prometheus())
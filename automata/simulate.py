@@ -0,0 +1,173 @@
+"""
+Offline playback simulator
+
+Plays charts through SekaiGamer without a phone: a fake client records every touch with its timestamp, and
+synthetic frames drive start detection and the fast/late judgement pixel. Reports how far taps land from the
+notes' true times, how many touch events are sent, and how long on_frame and play take.
+
+Run `python -m automata.simulate` to simulate every chart under config.music_path, or pass chart JSON paths.
+"""
+import argparse
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from numpy import ndarray
+from scrcpy import ACTION_DOWN
+
+from . import gamer
+from .chart import chart_files, load_chart
+from .config import config
+from .coords import stream_size
+
+dev = config.device
+note_ms = 30  # How long the synthetic first note takes to pass a visual line
+
+
+class FakeControl:
+    def __init__(self):
+        self.events: list[tuple[int, int, int, int, int]] = []  # (time ns, x, y, action, touch id)
+        self.pressed: list[int] = []  # Times (ns) of DOWN events
+
+    def touch(self, x: int, y: int, action: int, touch_id: int) -> None:
+        now = time.time_ns()
+        self.events.append((now, x, y, action, touch_id))
+        if action == ACTION_DOWN:
+            self.pressed.append(now)
+
+
+class FakeClient:
+    """ Stands in for scrcpy.Client. Without a control socket, TouchBatch sends events through control.touch """
+    control_socket = None
+
+    def __init__(self):
+        self.control = FakeControl()
+
+
+class TimedGamer(gamer.SekaiGamer):
+    """ SekaiGamer that records how long each on_frame and play call takes """
+    offline = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frame_ns: list[int] = []
+        self.play_ns: list[int] = []
+
+    def on_frame(self, frame: ndarray) -> None:
+        st = time.perf_counter_ns()
+        super().on_frame(frame)
+        self.frame_ns.append(time.perf_counter_ns() - st)
+
+    def play(self, ela: float) -> None:
+        st = time.perf_counter_ns()
+        super().play(ela)
+        self.play_ns.append(time.perf_counter_ns() - st)
+
+
+@dataclass
+class SimResult:
+    name: str
+    notes: int  # Taps and slide starts
+    pressed: int  # DOWN events received
+    errors: ndarray  # Touch time - true note time of each press (ms), in order
+    events: int  # Touch events received
+    seconds: float  # Simulated play time
+    frame_us: ndarray  # on_frame call durations (us)
+    play_us: ndarray  # play call durations (us)
+    adjusted: float  # Total fast/late adjustment of the gamer (ms)
+
+    def summary(self) -> str:
+        e = self.errors if len(self.errors) else np.zeros(1)
+        return (f"{self.name}: {self.pressed}/{self.notes} notes | error ms: mean {e.mean():+.2f}, "
+                f"|p50| {np.median(np.abs(e)):.2f}, |p99| {np.percentile(np.abs(e), 99):.2f}, "
+                f"|max| {np.abs(e).max():.2f} | "
+                f"{self.events / max(self.seconds, 1e-9):.0f} events/s | "
+                f"on_frame p50 {np.median(self.frame_us):.0f} us, play p50 {np.median(self.play_us):.0f} us, "
+                f"p99 {np.percentile(self.play_us, 99):.0f} us | adjusted {self.adjusted:+.2f} ms")
+
+
+def note_starts(notes: ndarray) -> ndarray:
+    """ Times (ms) of every press in a chart: taps and the first note of each slide, sorted """
+    slides = notes[notes['slide'] >= 0]
+    first = np.flatnonzero(np.diff(slides['slide'], prepend=-2))
+    return np.sort(np.concatenate([notes[notes['slide'] < 0]['t'], slides['t'][first]]).astype(np.int64))
+
+
+def simulate(notes: ndarray, name: str = 'chart', fps: float = None, offset: float = 0, judge_ms: float = 3,
+             seconds: float = None) -> SimResult:
+    """
+    Play a chart in real time against a fake client
+
+    :param notes: The note array of the chart (see chart.load_chart)
+    :param name: Name of the chart in the report
+    :param fps: Rate of the synthetic frames, config.device.fps by default. Start detection can only be as precise as
+        the frame interval allows
+    :param offset: How late (ms) the game judges notes compared to the detected start, as a miscalibrated device
+        would. The judgement pixel shows fast/late when a press is more than judge_ms away from the judged time.
+    :param judge_ms: See offset
+    :param seconds: Only play notes in the first seconds of the chart
+    :return: The result
+    """
+    if seconds is not None:
+        notes = notes[notes['t'] < notes['t'].min() + seconds * 1000]
+    starts = note_starts(notes)
+    client = FakeClient()
+    gm = TimedGamer(client, notes)
+    fps = fps or dev.fps or 60
+
+    # Synthetic frames: black, the first note falling through the visual lines, and the judgement pixel during play
+    w, h = stream_size
+    black = np.zeros((h, w, 3), np.uint8)
+    px = gamer.late_early_px
+
+    # Wall time at which the first note reaches the judgement line, after a short wait
+    st = time.time_ns()
+    first_ns = st + 200_000_000 + int(max(gamer.line_delay) * 1_000_000)
+    frame_time = st
+    while not gm.done:
+        frame = black
+        now = time.time_ns()
+        # Lines covered by the first note (note_ms long) at this time
+        left = (first_ns - now) / 1_000_000
+        lines = [y for y, d in zip(gamer.line_ys, gamer.line_delay) if left <= d < left + note_ms]
+        if lines:
+            frame = black.copy()
+            frame[lines] = 255
+        if gm.started:
+            pressed = client.control.pressed
+            if pressed:
+                i = min(len(pressed), len(starts)) - 1
+                err = (pressed[i] - first_ns) / 1_000_000 - (starts[i] - starts[0]) - offset
+                if abs(err) > judge_ms:
+                    frame = frame.copy()
+                    frame[px[1], px[0]] = gamer.late if err > 0 else gamer.fast
+        gm.on_frame(frame)
+
+        frame_time += int(1e9 / fps)
+        time.sleep(max(frame_time - time.time_ns(), 0) / 1e9)
+    end = time.time_ns()
+
+    pressed = np.array(client.control.pressed, np.int64)
+    n = min(len(pressed), len(starts))
+    errors = (pressed[:n] - first_ns) / 1_000_000 - (starts[:n] - starts[0]) - offset
+    return SimResult(name, len(starts), len(pressed), errors, len(client.control.events), (end - first_ns) / 1e9,
+                     np.array(gm.frame_ns) / 1000, np.array(gm.play_ns or [0]) / 1000, gm.late_early_total)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate chart playback without a device.")
+    parser.add_argument('charts', nargs='*', type=Path, help='Chart JSON files, every chart in music_path by default')
+    parser.add_argument('--seconds', type=float, default=30, help='Only play the first seconds of each chart')
+    parser.add_argument('--fps', type=float, help='Synthetic frame rate')
+    parser.add_argument('--offset', type=float, default=0, help='Simulated judgement offset (ms)')
+    args = parser.parse_args()
+
+    results = [simulate(load_chart(p), f'{p.parent.name}/{p.stem}', args.fps, args.offset, seconds=args.seconds)
+               for p in args.charts or chart_files()]
+    for r in results:
+        print(r.summary())
+    if len(results) > 1:
+        errors = np.concatenate([r.errors for r in results])
+        print(f"All {len(results)} charts: |error| p50 {np.median(np.abs(errors)):.2f} ms, "
+              f"p99 {np.percentile(np.abs(errors), 99):.2f} ms")
@@ -7,10 +7,159 @@ required and return the expected next stage. Also, each stage will have a unique
 constructor, which will be used to create a dictionary of stages.
 """
 import importlib
+import json
 import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
 from pathlib import Path
 
+from typing import TYPE_CHECKING
+
+from .config import get_log_path
+from .metrics import stage_metrics
 from .models import SekaiStage, SekaiStageContext
+from .util import ImageFinder, finder_windows, union_regions
+
+if TYPE_CHECKING:
+    from .vision import VisionPool
+
+# Screen regions read by any image finder, computed when the stages are loaded
+rois: list[tuple[slice, slice]] | None = None
+# Template rect of each image finder within rois (see SekaiStageContext.watch)
+watch: list[tuple[int, slice, slice]] | None = None
+
+# Worker processes that check frame-only stages, None to check them in this process (see config.vision_workers)
+vision: 'VisionPool | None' = None
+
+
+class StageScheduler:
+    """
+    Learns how often each stage follows another (persisted across runs), and orders the stages that are not expected
+    by the last operation so that the likeliest next stage per second of is_stage time is checked first.
+
+    Stages named with a numeric priority prefix (e.g. "002_wait_mp_matching") are never moved ahead of a stage with
+    a lower prefix, because their order decides which stage wins on screens that match more than one.
+    """
+    counts: dict[str, Counter]  # prev -> next -> count
+    pending: dict[str, Counter]  # Transitions recorded since the last save
+    path: Path | None  # None to keep the counts in memory only
+    default_cost: float = 0.001  # Assumed is_stage time (seconds) before a stage has been measured
+    save_interval: float = 10  # Seconds between saves (the transitions of the last few are lost on os._exit)
+
+    def __init__(self, path: Path | None):
+        self.path = path
+        self.pending = {}
+        self.lock = threading.Lock()  # Shared by the sessions of all devices
+        self.saver: threading.Thread | None = None
+        self.counts = self.load()
+
+    def load(self) -> dict[str, Counter]:
+        """
+        Read the counts saved on disk
+
+        :return: The counts, empty if there are none
+        """
+        if not self.path or not self.path.is_file():
+            return {}
+        try:
+            return {k: Counter(v) for k, v in json.loads(self.path.read_text('utf-8')).items()}
+        except ValueError as e:
+            logging.error(f'[STAGE] Failed to load stage transitions from {self.path}: {e}')
+            return {}
+
+    def record(self, prev: str | None, stage: str) -> None:
+        """
+        Record a transition, it's saved to disk in the background
+        """
+        with self.lock:
+            self.counts.setdefault(prev or 'none', Counter())[stage] += 1
+            if not self.path:
+                return
+            self.pending.setdefault(prev or 'none', Counter())[stage] += 1
+            if self.saver is None:
+                self.saver = threading.Thread(target=self._save_loop, name='stage-transitions', daemon=True)
+                self.saver.start()
+
+    def _save_loop(self) -> None:
+        while True:
+            time.sleep(self.save_interval)
+            self.save()
+
+    def save(self) -> None:
+        """
+        Add the pending transitions to the counts on disk and pick up the ones other processes added (start1.ps1
+        runs one process per device on the same log path). The file is replaced atomically, so a process killed
+        while saving leaves the previous counts intact.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        counts = self.load()
+        for prev, c in pending.items():
+            counts.setdefault(prev, Counter()).update(c)
+        tmp = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_text(json.dumps(counts, indent=1), 'utf-8')
+            os.replace(tmp, self.path)
+        except OSError as e:
+            # e.g. another process has the file open on Windows, try again next time
+            logging.warning(f'[STAGE] Failed to save stage transitions to {self.path}: {e}')
+            with self.lock:
+                for prev, c in pending.items():
+                    self.pending.setdefault(prev, Counter()).update(c)
+            return
+        with self.lock:
+            # Keep the transitions recorded while saving
+            for prev, c in self.pending.items():
+                counts.setdefault(prev, Counter()).update(c)
+            self.counts = counts
+
+    def score(self, prev: str | None, stage: str, n: int) -> float:
+        """
+        Probability of the stage following prev (with add-one smoothing over n candidates) per second of cost
+        """
+        c = self.counts.get(prev or 'none', Counter())
+        p = (c[stage] + 1) / (sum(c.values()) + n)
+        return p / self.cost(stage)
+
+    def cost(self, stage: str) -> float:
+        """
+        Expected is_stage time of a stage (seconds)
+        """
+        return stage_metrics.avg_seconds(stage) or self.default_cost
+
+    def order(self, prev: str | None, names: set[str]) -> list[str]:
+        """
+        Order the stages to check
+
+        :param prev: The previously found stage
+        :param names: The names of the stages to check
+        :return: The names in the order to check them
+        """
+        def prio(name: str) -> int | None:
+            m = re.match(r'(\d+)_', name)
+            return int(m.group(1)) if m else None
+
+        with self.lock:
+            scores = {k: self.score(prev, k, len(names)) for k in names}
+        left = sorted(names, key=lambda k: (-scores[k], k))
+        out = []
+        while left:
+            # Best scored stage that has no prefixed stage with a lower prefix still left
+            for k in left:
+                if prio(k) is None or all(prio(o) is None or prio(o) >= prio(k) for o in left):
+                    break
+            left.remove(k)
+            out.append(k)
+        return out
+
+
+scheduler = StageScheduler(get_log_path() / 'stage_transitions.json')
 
 
 def load_stages() -> dict[str, SekaiStage]:
@@ -19,6 +168,8 @@ def load_stages() -> dict[str, SekaiStage]:
 
     :return: A dictionary of stages
     """
+    global rois, watch
+
     # Import each module in "stages" package
     for p in Path(__file__).parent.glob('stages/*.py'):
         importlib.import_module(f'.stages.{p.stem}', package='automata')
@@ -30,9 +181,99 @@ def load_stages() -> dict[str, SekaiStage]:
 
     # Get all subclasses of SekaiStage
     stages = {cls() for cls in sub if cls.__module__.startswith('automata.stages')}
+
+    # All image finders are loaded by now
+    rois = union_regions(ImageFinder.instances)
+    watch = finder_windows(ImageFinder.instances, rois)
     return {stage.name: stage for stage in stages}
 
 
+def get_rois() -> list[tuple[slice, slice]] | None:
+    """
+    Get the screen regions that stage detection reads
+
+    :return: (y slice, x slice) of each region, None if the stages have not been loaded
+    """
+    return rois
+
+
+def get_watch() -> list[tuple[int, slice, slice]] | None:
+    """
+    Get the regions whose change makes a frame count as changed
+
+    :return: (index in get_rois(), y slice, x slice inside that roi) of each region, None if the stages have not
+        been loaded
+    """
+    return watch
+
+
+def start_vision(workers: int) -> None:
+    """
+    Check frame-only stages in a pool of worker processes from now on
+
+    :param workers: Number of worker processes
+    """
+    global vision
+    from .vision import VisionPool
+    vision = VisionPool(workers)
+
+
+def check_stage(ctx: SekaiStageContext, stage: SekaiStage) -> bool:
+    """
+    Check whether the current frame is the stage, reusing the last negative verdict if the screen has not changed
+
+    :param ctx: The context object
+    :param stage: The stage to check
+    :return: True if the current frame is the stage
+    """
+    # Verdicts are cleared whenever the screen changes (and on the periodic refresh in Session.find_next), so any
+    # verdict left is for the same screen
+    if stage.frame_only and ctx.verdicts.get(stage.name) is False:
+        stage_metrics.reuse(stage.name)
+        return False
+    st = time.perf_counter()
+    res = bool(stage.is_stage(ctx))
+    stage_metrics.record(stage.name, time.perf_counter() - st, res)
+    ctx.verdicts[stage.name] = res
+    return res
+
+
+def _found(ctx: SekaiStageContext, stage: SekaiStage, expected: bool) -> SekaiStage:
+    stage_metrics.transition(ctx.last_stage, stage.name, expected)
+    scheduler.record(ctx.last_stage, stage.name)
+    ctx.last_stage = stage.name
+    return stage
+
+
+def _first_match(ctx: SekaiStageContext, stages: dict[str, SekaiStage], names: list[str]) -> SekaiStage | None:
+    """
+    Check stages in order until one matches. With a vision pool, each run of consecutive frame-only stages is checked
+    by a worker process in one call.
+    """
+    i = 0
+    while i < len(names):
+        stage = stages[names[i]]
+        if vision is None or not stage.frame_only:
+            if check_stage(ctx, stage):
+                return stage
+            i += 1
+            continue
+
+        run = []
+        while i < len(names) and stages[names[i]].frame_only:
+            run.append(names[i])
+            i += 1
+        todo = []
+        for name in run:
+            if ctx.verdicts.get(name) is False:
+                stage_metrics.reuse(name)
+            else:
+                todo.append(name)
+        hit = todo and vision.first_hit(ctx, todo)
+        if hit:
+            return stages[hit]
+
+
 def find_stage(ctx: SekaiStageContext, stages: dict[str, SekaiStage]) -> SekaiStage | None:
     """
     Find the current stage
@@ -47,19 +288,16 @@ def find_stage(ctx: SekaiStageContext, stages: dict[str, SekaiStage]) -> SekaiSt
     # Check the expected stage first
     expect = set(ctx.last_op.next_stage) if ctx.last_op else set()
 
-    for stage_name in sorted(expect):
-        if stage_name not in stages:
-            logging.error(f'[STAGE] Stage {stage_name} is not found in the stages')
-            continue
-        stage = stages[stage_name]
-
-        if stage.is_stage(ctx):
-            return stage
-
-    # Check the remaining stages
-    for stage_name in sorted(set(stages.keys()) - set(expect)):
-        stage = stages[stage_name]
-        if stage.is_stage(ctx):
-            if expect:
-                logging.warning(f'[STAGE] Stage {stage_name} is not expected. Expected stages are: {expect}')
-            return stage
+    for stage_name in sorted(expect - set(stages)):
+        logging.error(f'[STAGE] Stage {stage_name} is not found in the stages')
+    stage = _first_match(ctx, stages, sorted(expect & set(stages)))
+    if stage:
+        return _found(ctx, stage, True)
+
+    # Check the remaining stages, likeliest first
+    ctx.check_order = scheduler.order(ctx.last_stage, set(stages.keys()) - set(expect))
+    stage = _first_match(ctx, stages, ctx.check_order)
+    if stage:
+        if expect:
+            logging.warning(f'[STAGE] Stage {stage.name} is not expected. Expected stages are: {expect}')
+        return _found(ctx, stage, not expect)
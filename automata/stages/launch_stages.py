@@ -5,11 +5,12 @@ import requests
 from ..actions import ATap, ADelay
 from ..config import log, HOST_ADDR, get_mode
 from ..models import SekaiStage, SekaiStageContext, SekaiStageOp
-from ..util import ImageFinder
+from ..util import ImageFinder, TemplateBank
 
 
 class MatchAndClick(SekaiStage):
     images: dict[str, ImageFinder]
+    bank: TemplateBank
 
     def __init__(self):
         super().__init__("050_match_and_click")
@@ -40,17 +41,22 @@ class MatchAndClick(SekaiStage):
             # Errors
             'communication_error_back',
         ]}
+        self.bank = TemplateBank(self.images)
 
     def is_stage(self, ctx: SekaiStageContext) -> bool:
-        # Match images
-        for name, image in self.images.items():
-            pos = image.check(ctx.frame_gray)
-            if pos:
-                ctx.cache['match-name'] = name
-                ctx.cache['match-pos'] = pos
-                if 'mp_matching_since' in ctx.store:
-                    del ctx.store['mp_matching_since']
-                return True
+        # Match all images at once and take the best one
+        hits = self.bank.match(ctx.frame_gray)
+        if not hits:
+            return False
+        if len(hits) > 1:
+            log.warning(f"[MATCH] Ambiguous match: {', '.join(f'{n} ({s:.3f})' for n, s in hits)}")
+
+        name = hits[0][0]
+        ctx.cache['match-name'] = name
+        ctx.cache['match-pos'] = self.images[name].center
+        if 'mp_matching_since' in ctx.store:
+            del ctx.store['mp_matching_since']
+        return True
 
     def operate(self, ctx: SekaiStageContext) -> SekaiStageOp:
         # Get the image
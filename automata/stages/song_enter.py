@@ -1,11 +1,11 @@
-import json
 from pathlib import Path
 
 import cv2
 import numpy as np
 
 from ..actions import ADelay
-from ..config import log, config, global_dict
+from ..chart import load_chart
+from ..config import log, config
 from ..gamer import SekaiGamer
 from ..models import SekaiStage, SekaiStageContext, SekaiStageOp
 from ..util import ImageFinder, SongFinder
@@ -32,54 +32,66 @@ def find_difficulty(difficulty_img: np.ndarray) -> str:
 
 
 class SongStart(SekaiStage):
+    stream_mode = 'play'
     song_start_if: ImageFinder
+    song_cover_if: ImageFinder
+    song_difficulty_if: ImageFinder
 
     def __init__(self):
         super().__init__("song_start")
         self.song_start_if = ImageFinder('song_start')
+        self.song_cover_if = ImageFinder('song_cover')
+        self.song_difficulty_if = ImageFinder('song_difficulty')
 
     def is_stage(self, ctx: SekaiStageContext) -> bool:
         return bool(self.song_start_if.check(ctx.frame_gray))
 
     def operate(self, ctx: SekaiStageContext) -> SekaiStageOp:
-        # Pass a delay to ensure the song starts
-        ctx.store['song_start_next'] = True
-        return SekaiStageOp("song_start", [ADelay(0.6)], {'song_start_next'})
+        # Entering play mode reconnects the stream (see Session.set_mode), so keep the cover and difficulty from this
+        # frame. song_start_next identifies the song after a delay, to ensure the song starts.
+        ctx.store['song_start_next'] = {
+            'cover': self.song_cover_if.get_region(ctx.frame).copy(),
+            'difficulty': self.song_difficulty_if.get_region(ctx.frame).copy(),
+            'at': ctx.time + 600,
+        }
+        return SekaiStageOp("song_start", [ADelay(0.01)], {'song_start_next'})
 
 
 class SongStartNext(SekaiStage):
-    song_cover_if: ImageFinder
-    song_difficulty_if: ImageFinder
+    frame_only = False
+    stream_mode = 'play'
     song_finder: SongFinder
 
     def __init__(self):
         super().__init__("song_start_next")
-        self.song_cover_if = ImageFinder('song_cover')
-        self.song_difficulty_if = ImageFinder('song_difficulty')
         self.song_finder = SongFinder()
 
     def is_stage(self, ctx: SekaiStageContext) -> bool:
-        return ctx.store.get('song_start_next', False)
+        s = ctx.store.get('song_start_next')
+        return bool(s) and ctx.time >= s['at']
 
     def operate(self, ctx: SekaiStageContext) -> SekaiStageOp:
-        del ctx.store['song_start_next']
+        s = ctx.store.pop('song_start_next')
         # Get the song cover
-        cover = self.song_cover_if.get_region(ctx.frame)
-        song_id, song = self.song_finder.find(cover)
+        cover = s['cover']
+        found = self.song_finder.find(cover)
+        if not found:
+            log.error("Song cover not recognized")
+            return SekaiStageOp("song_start", [ADelay(0.01)], set())
+        song_id, song = found
 
         # Check the difficulty using color similarity
-        diff = self.song_difficulty_if.get_region(ctx.frame)
-        d = find_difficulty(diff)
+        d = find_difficulty(s['difficulty'])
 
         # Load notes
         p = Path(config.music_path.replace('{ID}', str(song_id).zfill(3))) / f'{d}.json'
         if not p.exists():
             log.error(f"Notes not found: {p}")
             return SekaiStageOp("song_start", [ADelay(0.01)], set())
-        notes = json.loads(p.read_text('utf-8'))
+        notes = load_chart(p)
 
         log.info(f"> Song start: {song['title']} ({d})")
-        global_dict['playing'] = SekaiGamer(ctx.client, notes)
+        ctx.playing = SekaiGamer(ctx.client, notes)
 
         return SekaiStageOp("song_start", [ADelay(0.01)], set())
 
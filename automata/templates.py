@@ -0,0 +1,105 @@
+"""
+Resolution independent template store
+
+Templates are cut with editor.py at one screen resolution and kept in `stages/editor-{w}x{h}`. Image finders work on
+the frames of the stream (see coords.py), and a stream size with its own set uses it directly. For any other size,
+the highest resolution set that has the template is resampled once: positions are normalized by the source width
+and scaled to the screen width (the game UI scales with the width, the rule automata/tools/scale.py applied by hand),
+and the result is cached in `stages/scaled-{w}x{h}` until the source changes.
+"""
+import math
+import os
+import re
+from pathlib import Path
+
+import cv2
+import toml
+
+from .coords import stream_size
+
+stages_path = Path(__file__).parent / 'stages'
+# Bump when resampling changes, so that cached copies are made again
+version = 2
+source_re = re.compile(r'editor-(\d+)x(\d+)')
+
+
+def sources() -> list[tuple[int, int, Path]]:
+    """
+    Template sets cut with the editor
+
+    :return: (width, height, path) of each set, highest resolution first
+    """
+    out = []
+    for p in stages_path.iterdir():
+        m = source_re.fullmatch(p.name)
+        if m and p.is_dir():
+            out.append((int(m[1]), int(m[2]), p))
+    return sorted(out, reverse=True)
+
+
+def template_dir(name: str) -> Path:
+    """
+    Find the template files (meta.toml and crop.png) for the stream size, resampling them if needed
+
+    :param name: The template name (its directory in the editor output)
+    :return: The directory
+    :raise FileNotFoundError: If no template set has the template
+    """
+    w, h = stream_size
+    exact = stages_path / f'editor-{w}x{h}' / name
+    if exact.is_dir():
+        return exact
+    for sw, sh, src in sources():
+        if (src / name).is_dir():
+            return resample(src / name, w / sw, stages_path / f'scaled-{w}x{h}' / name)
+    raise FileNotFoundError(f"Image finder {name} not found")
+
+
+def resample(src: Path, scale: float, out: Path) -> Path:
+    """
+    Scale a template and its coordinates, unless an up-to-date copy is cached
+
+    :param src: The source template directory
+    :param scale: Target screen width / source screen width
+    :param out: The output directory
+    :return: The output directory
+    """
+    crop_p, meta_p = src / 'crop.png', src / 'meta.toml'
+    if (out / 'meta.toml').is_file() and (out / 'crop.png').is_file() and \
+            (out / 'crop.png').stat().st_mtime >= max(crop_p.stat().st_mtime, meta_p.stat().st_mtime) and \
+            toml.loads((out / 'meta.toml').read_text('utf-8')).get('resampled') == version:
+        return out
+
+    meta = toml.loads(meta_p.read_text('utf-8'))
+    crop = cv2.imread(str(crop_p))
+    # The editor drew its rectangle on the first row and column of the crop (see ImageFinder): scale only the content
+    # after it, then put a one pixel border back so that the result loads the same way
+    content = crop[1:, 1:] if min(crop.shape[:2]) > 1 else crop
+    x0, y0 = meta['start'][0] + 1, meta['start'][1] + 1
+    ch, cw = content.shape[:2]
+
+    # Keep only the target pixels that lie entirely on the content, and cut the source at their edges. The template
+    # is then sampled in the same phase as the downscaled frame (half a pixel off costs ~0.1 of match score)
+    tx0, ty0 = math.ceil(x0 * scale), math.ceil(y0 * scale)
+    tx1, ty1 = max(math.floor((x0 + cw) * scale), tx0 + 1), max(math.floor((y0 + ch) * scale), ty0 + 1)
+    sx0, sy0 = min(round(tx0 / scale) - x0, cw - 1), min(round(ty0 / scale) - y0, ch - 1)
+    sx1, sy1 = max(min(round(tx1 / scale) - x0, cw), sx0 + 1), max(min(round(ty1 / scale) - y0, ch), sy0 + 1)
+    content = cv2.resize(content[sy0:sy1, sx0:sx1], (tx1 - tx0, ty1 - ty0),
+                         interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    crop = cv2.copyMakeBorder(content, 1, 0, 1, 0, cv2.BORDER_REPLICATE)
+
+    meta['start'] = [tx0 - 1, ty0 - 1]
+    meta['end'] = [tx1, ty1]
+    meta['resampled'] = version
+    if 'offset' in meta:
+        meta['offset'] = [round(v * scale) for v in meta['offset']]
+
+    # Several processes may resample at the same time (see vision.py), so files are replaced atomically. The crop is
+    # written last, its time marks the copy as complete.
+    out.mkdir(parents=True, exist_ok=True)
+    for name, data in (('meta.toml', toml.dumps(meta).encode('utf-8')),
+                       ('crop.png', cv2.imencode('.png', crop)[1].tobytes())):
+        tmp = out / f'{name}.{os.getpid()}.tmp'
+        tmp.write_bytes(data)
+        os.replace(tmp, out / name)
+    return out
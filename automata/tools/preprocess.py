@@ -3,9 +3,12 @@ import pickle
 from pathlib import Path
 
 import imagehash
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
+from automata.util import color_hist
+
 BASE_DIR = Path(r"Y:\Mugs\Sekai\sekai-jp-assets\music\jacket")
 
 
@@ -17,5 +20,18 @@ def cover_hash():
         pickle.dump(hashes, f)
 
 
+def cover_fingerprints():
+    # Compute and store the extra signatures (dHash, color histogram) used when pHash is ambiguous
+    def fingerprint(p: Path):
+        rgb = Image.open(str(p)).convert('RGB')
+        return imagehash.dhash(rgb), color_hist(np.array(rgb))
+
+    img = BASE_DIR.glob("*/jacket_s_*.png")
+    fps = {p.stem.split('_')[-1]: fingerprint(p) for p in tqdm(img)}
+    with open("cover_fingerprints.pkl", "wb") as f:
+        pickle.dump(fps, f)
+
+
 if __name__ == '__main__':
-    cover_hash()
\ No newline at end of file
+    cover_hash()
+    cover_fingerprints()
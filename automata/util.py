@@ -1,8 +1,12 @@
 import inspect
 import json
+import math
 import pickle
+import threading
 import time
+from collections import Counter, deque
 from pathlib import Path
+from typing import Literal
 
 import cv2
 import imagehash
@@ -14,6 +18,29 @@ from imagehash import ImageHash
 from numpy import ndarray
 
 from .config import config
+from .templates import template_dir
+
+# Fast-reject thresholds for ImageFinder.prefilter
+# TM_CCOEFF_NORMED ignores brightness and contrast, and dimmed buttons (e.g. bmp_launch) still match at ~85 gray
+# levels darker with half the contrast, so these are kept loose enough not to reject any match in the captures
+prefilter_min_std = 3  # Regions flatter than this can't correlate with a template
+prefilter_mean_tol = 100  # Max gray level difference between the template and a window mean
+prefilter_std_ratio = 3  # Max ratio between the template and a window standard deviation
+prefilter_hist_bins = 16
+prefilter_hist_overlap = 0.1  # Min histogram intersection, relative to a perfect match
+
+# Song cover identification
+cover_cascade_margin = 6  # Compare dHash and colors when the top pHash candidates are closer than this
+cover_hist_weight = 32  # Weight of the color histogram distance (0 ~ 1) against hamming distances
+cover_max_distance = 12  # pHash distances above this are not considered a match (random images score 16+)
+mih_max_probe_bits = 2  # Widest SongFinder index probe (covers hashes within distance 23), linear scan beyond
+# Masks of the 8-bit chunk values that are b bits away, by b
+probe_masks = [[m for m in range(256) if m.bit_count() == b] for b in range(9)]
+
+# Counters of ImageFinder checks: 'check', 'match' and 'reject_{reason}' for every early rejection
+check_stats: Counter = Counter()
+# Counters of SongFinder searches: 'mih_{b}' when answered by the index with probes up to b bits, 'linear' otherwise
+search_stats: Counter = Counter()
 
 
 def ncc_sim(a: ndarray, b: ndarray) -> float:
@@ -42,14 +69,58 @@ def ncc_sim(a: ndarray, b: ndarray) -> float:
     return np.sum(a * b) / (np.sqrt(np.sum(a ** 2)) * np.sqrt(np.sum(b ** 2)))
 
 
+def pack_hash(h: ImageHash) -> int:
+    """
+    Pack a 64-bit image hash into an integer (row-major bits, first bit is the most significant)
+    """
+    return int.from_bytes(np.packbits(h.hash.flatten()).tobytes(), 'big')
+
+
+def popcount(a: ndarray) -> ndarray:
+    """
+    Count the set bits of each element of a uint64 array
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(a)
+    return np.unpackbits(a.view(np.uint8)).reshape(*a.shape, 64).sum(axis=-1)
+
+
+def color_hist(rgb: ndarray) -> ndarray:
+    """
+    Color signature of a cover: normalized per-channel histograms, concatenated
+    """
+    hist = np.concatenate([cv2.calcHist([rgb], [c], None, [16], [0, 256]).ravel() for c in range(3)])
+    return hist / hist.sum()
+
+
+def hist_dist(a: ndarray, b: ndarray) -> float:
+    """
+    Distance between two color signatures, in [0, 1]
+    """
+    return float(np.abs(a - b).sum() / 2)
+
+
 class SongFinder:
     """
     Finds a song from the screen based on cover image similarity
+
+    The cover hashes are packed into a uint64 array and compared with vectorized XOR + popcount. With
+    index='mih', a multi-index hash over the eight 8-bit chunks of the hashes narrows down the candidates first: a
+    hash within hamming distance 8 * (b + 1) - 1 of the query has at least one chunk within b bits of the query's
+    chunk, so probing every chunk value up to b bits away finds all of them. Probing starts at b = 0 and widens until
+    the search radius is covered, and falls back to the linear scan beyond mih_max_probe_bits. In Python the probes
+    cost more than the popcounts they save (~30 us against ~20 us for a scan of 480 covers, and still slower at 50k),
+    so the linear scan is the default.
     """
     cover_hashes: dict[str, ImageHash]
     music_data: dict[int, dict]
+    ids: ndarray
+    packed: ndarray
+    index: str
+    chunks: list[list[list[int]]]  # For each 8-bit chunk: chunk value -> indices in packed
+    fingerprints: dict[int, tuple[int, ndarray]]  # Song id -> (packed dHash, color histogram)
 
-    def __init__(self):
+    def __init__(self, index: Literal['linear', 'mih'] = 'linear'):
         # Load cover hashes from picle
         with (Path(__file__).parent / 'data/cover_hashes.pkl').open('rb') as f:
             self.cover_hashes = pickle.load(f)
@@ -57,15 +128,101 @@ class SongFinder:
         self.music_data = {it['id']: it for it in json.loads(
             (Path(__file__).parent / 'data/musics.json').read_text('utf-8'))}
 
-    def find(self, cover: ndarray) -> tuple[int, dict]:
-        # Covert to PIL image
-        cover_hash = imagehash.phash(Image.fromarray(cv2.resize(cover, (740, 740))))
-        # Find the lowest hash distance
-        hashes = list(self.cover_hashes.items())
-        scores = [cover_hash - hsh for _, hsh in hashes]
-        best = np.argmin(scores)
-        id = int(hashes[best][0])
-        print(f"> Song finder best match: ID {id} - Score {scores[best]}")
+        # Pack the hashes (skipping entries that aren't song ids, e.g. 'org')
+        hashes = [(int(k), h) for k, h in self.cover_hashes.items() if k.isdigit()]
+        self.ids = np.array([k for k, _ in hashes])
+        self.packed = np.array([pack_hash(h) for _, h in hashes], dtype=np.uint64)
+
+        # Load the extra signatures for ambiguous covers (computed by tools/preprocess.py), if available
+        self.fingerprints = {}
+        fp = Path(__file__).parent / 'data/cover_fingerprints.pkl'
+        if fp.is_file():
+            with fp.open('rb') as f:
+                self.fingerprints = {int(k): (pack_hash(dh), hist) for k, (dh, hist) in pickle.load(f).items()
+                                     if k.isdigit()}
+
+        # Build the multi-index
+        self.index = index
+        self.chunks = [[[] for _ in range(256)] for _ in range(8)]
+        for i, h in enumerate(self.packed.tolist()):
+            for c, chunk in enumerate(self.chunks):
+                chunk[(h >> (8 * c)) & 0xFF].append(i)
+
+    def search(self, cover_hash: ImageHash, margin: int) -> list[tuple[int, int]]:
+        """
+        Find the closest cover and every cover within a margin of it
+
+        :param cover_hash: The perceptual hash of the cover
+        :param margin: Also return the covers less than this much farther than the closest one
+        :return: (song id, hamming distance) of each candidate, closest first
+        """
+        q = pack_hash(cover_hash)
+        if self.index == 'mih':
+            found: set[int] = set()
+            idx, dist = np.zeros(0, int), np.zeros(0, np.uint64)
+            for b in range(mih_max_probe_bits + 1):
+                new = set()
+                for c, chunk in enumerate(self.chunks):
+                    v = (q >> (8 * c)) & 0xFF
+                    for m in probe_masks[b]:
+                        new.update(chunk[v ^ m])
+                new -= found
+                if new:
+                    found |= new
+                    new_idx = np.fromiter(new, int, len(new))
+                    idx = np.concatenate([idx, new_idx])
+                    dist = np.concatenate([dist, popcount(self.packed[new_idx] ^ np.uint64(q))])
+                if not len(idx):
+                    continue
+                # Every cover within this radius has been found, so the result is exact if it fits in the radius
+                if dist.min() + margin - 1 <= 8 * (b + 1) - 1:
+                    search_stats[f'mih_{b}'] += 1
+                    return self._closest(idx, dist, margin)
+
+        search_stats['linear'] += 1
+        return self._closest(np.arange(len(self.packed)), popcount(self.packed ^ np.uint64(q)), margin)
+
+    def _closest(self, idx: ndarray, dist: ndarray, margin: int) -> list[tuple[int, int]]:
+        order = np.argsort(dist, kind='stable')
+        order = order[dist[order] < dist[order[0]] + margin]
+        return list(zip(self.ids[idx[order]].tolist(), dist[order].tolist()))
+
+    def find(self, cover: ndarray) -> tuple[int, dict] | None:
+        """
+        Identify the song from its cover
+
+        The pHash is computed on the cover as is (phash downsamples to 32x32 itself). Only when the best two
+        candidates are within cover_cascade_margin of each other, the dHash and color histogram of the close
+        candidates are compared as well.
+
+        :param cover: The cover image (BGR)
+        :return: (song id, music data), None if no cover is close enough
+        """
+        rgb = cv2.cvtColor(cover, cv2.COLOR_BGR2RGB)
+        img = Image.fromarray(rgb)
+        cands = self.search(imagehash.phash(img), cover_cascade_margin)
+        id, score = cands[0]
+        # Other covers are at least cover_cascade_margin farther when there are none in the candidates
+        margin = cands[1][1] - score if len(cands) > 1 else cover_cascade_margin
+
+        if margin < cover_cascade_margin and self.fingerprints:
+            close = [(cid, d) for cid, d in cands if cid in self.fingerprints]
+            if len(close) > 1:
+                dh = pack_hash(imagehash.dhash(img))
+                hist = color_hist(rgb)
+
+                def combined(c: tuple[int, int]) -> float:
+                    fdh, fhist = self.fingerprints[c[0]]
+                    return c[1] + (dh ^ fdh).bit_count() + cover_hist_weight * hist_dist(hist, fhist)
+
+                # The pick may be a few bits farther than the best pHash match, the distance gate applies to it
+                id, score = min(close, key=combined)
+                print(f"> Song finder ambiguous (margin {margin}), cascade picked ID {id} from {close}")
+
+        print(f"> Song finder best match: ID {id} - Score {score} - Margin {margin}{'' if len(cands) > 1 else '+'}")
+        if score > cover_max_distance:
+            print(f"> Song finder: no cover within distance {cover_max_distance}")
+            return None
         return id, self.music_data[id]
 
 
@@ -82,14 +239,22 @@ class ImageFinder:
     offset: tuple[int, int]
     crop: ndarray
     gray: ndarray
+    pyramid: list[ndarray]  # gray at every scale in config.template_scales, gray itself first
+    margin: int  # How much further than gray the largest scale reaches on each side
+
+    # Template signatures for the fast-reject pre-filter
+    mean: float
+    std: float
+    hist: ndarray
+
+    # All image finders that have been loaded
+    instances: list['ImageFinder'] = []
 
     def __init__(self, name: str):
         # Load the image finder data from the editor by directory name
         self.name = name
-        w, h = config.device.screen_size
-        p = Path(__file__).parent / f'stages/editor-{w}x{h}/{name}'
-        if not p.is_dir():
-            raise FileNotFoundError(f"Image finder {name} not found")
+        ImageFinder.instances.append(self)
+        p = template_dir(name)
 
         # Load the metadata
         with (p / 'meta.toml').open() as f:
@@ -110,6 +275,25 @@ class ImageFinder:
             self.crop = cv2.imread(str(p / 'crop.png'))
         self.gray = cv2.cvtColor(self.crop, cv2.COLOR_BGR2GRAY)
 
+        # Also match slightly scaled templates, for screens that are not an exact multiple of the template set
+        scales = [s for s in config.template_scales or [] if s != 1]
+        th, tw = self.gray.shape
+        self.pyramid = [self.gray] + [cv2.resize(self.gray, (max(round(tw * s), 1), max(round(th * s), 1)),
+                                                 interpolation=cv2.INTER_AREA if s < 1 else cv2.INTER_CUBIC)
+                                      for s in scales]
+        self.margin = max(0, math.ceil(max(th, tw) * (max(scales, default=1) - 1) / 2))
+
+        # Compute the signatures used by the pre-filter
+        mean, std = cv2.meanStdDev(self.gray)
+        self.mean, self.std = float(mean[0, 0]), float(std[0, 0])
+        self.hist = self._hist(self.gray)
+
+    @staticmethod
+    def _hist(gray: ndarray) -> ndarray:
+        """ Normalized gray level histogram """
+        hist = cv2.calcHist([gray], [0], None, [prefilter_hist_bins], [0, 256]).ravel()
+        return hist / hist.sum()
+
     def get_region(self, frame: ndarray, widen: int = 0) -> ndarray:
         """
         Crop the UI element from the screen frame
@@ -129,22 +313,176 @@ class ImageFinder:
         :param frame: The screen frame (grayscale)
         :return: The center position (including offset) when found, None otherwise
         """
-        region = self.get_region(frame, 5)
+        region = self.get_region(frame, 5 + self.margin)
 
-        # Save region and expected for debug
+        # Save region and expected for debug (the region is a view of the reused frame_gray buffer)
         if config.debug:
-            cv2.imwrite(f"debug/{self.name}_region.png", region)
-            cv2.imwrite(f"debug/{self.name}_expected.png", self.gray)
+            image_writer.write(f"debug/{self.name}_region.png", region.copy())
+            image_writer.write(f"debug/{self.name}_expected.png", self.gray)
 
         # Check if frame is grayscale
         if len(region.shape) == 3:
             region = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
 
+        # Skip the expensive similarity check if the region obviously doesn't match
+        check_stats['check'] += 1
+        reason = self.prefilter(region)
+        if reason:
+            check_stats[f'reject_{reason}'] += 1
+            return None
+
         # Check similarity
-        res = max(cv2.matchTemplate(region, self.gray, cv2.TM_CCOEFF_NORMED).flatten())
-        if res > config.image_threshold:
+        if self.score(region) > config.image_threshold:
+            check_stats['match'] += 1
             return self.center
 
+    def score(self, region: ndarray) -> float:
+        """
+        Best TM_CCOEFF_NORMED score of the template (at any scale of the pyramid) within a widened region
+
+        :param region: The widened region (grayscale)
+        :return: The score, -1 if no scale of the template fits in the region
+        """
+        return max((cv2.minMaxLoc(cv2.matchTemplate(region, t, cv2.TM_CCOEFF_NORMED))[1] for t in self.pyramid
+                    if t.shape[0] <= region.shape[0] and t.shape[1] <= region.shape[1]), default=-1.0)
+
+    def prefilter(self, region: ndarray) -> str | None:
+        """
+        Cheaply check whether a widened region can possibly contain the UI element, by comparing the template's
+        mean/std/histogram signatures against the region. Window statistics are computed for every offset at once
+        using integral images.
+
+        :param region: The widened region (grayscale)
+        :return: The reason if the region is rejected ('flat', 'stats' or 'hist'), None if it needs a full check
+        """
+        # A flat region (e.g. a black loading screen) can't correlate with a textured template
+        if self.std >= prefilter_min_std and cv2.meanStdDev(region)[1][0, 0] < prefilter_min_std:
+            return 'flat'
+
+        # Mean and std of every window position in the region
+        th, tw = self.gray.shape
+        s, sq = cv2.integral2(region, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        n = th * tw
+        m = (s[th:, tw:] - s[:-th, tw:] - s[th:, :-tw] + s[:-th, :-tw]) / n
+        v = (sq[th:, tw:] - sq[:-th, tw:] - sq[th:, :-tw] + sq[:-th, :-tw]) / n - m * m
+        sd = np.sqrt(np.maximum(v, 0))
+        ok = np.abs(m - self.mean) <= prefilter_mean_tol
+        if self.std >= prefilter_min_std:
+            ok &= (sd * prefilter_std_ratio >= self.std) & (sd <= self.std * prefilter_std_ratio)
+        if not ok.any():
+            return 'stats'
+
+        # The template covers only part of the widened region, so even a perfect match only overlaps this much
+        frac = n / region.size
+        if np.minimum(self.hist, self._hist(region)).sum() < prefilter_hist_overlap * frac:
+            return 'hist'
+
+        return None
+
+
+def union_regions(finders: list[ImageFinder], widen: int = 5) -> list[tuple[slice, slice]]:
+    """
+    Merge the widened regions of image finders into a set of non-overlapping rectangles
+
+    :param finders: The image finders
+    :param widen: The number of pixels the regions are widened by when checking (plus each finder's pyramid margin)
+    :return: (y slice, x slice) of each merged rectangle
+    """
+    rects = []
+    for x0, y0, x1, y1 in sorted({(max(f.start[0] - widen - f.margin, 0), max(f.start[1] - widen - f.margin, 0),
+                                   f.end[0] + widen + f.margin, f.end[1] + widen + f.margin) for f in finders}):
+        # Merge with every rectangle this overlaps, until nothing overlaps anymore
+        merged = True
+        while merged:
+            merged = False
+            for r in rects:
+                if x0 < r[2] and r[0] < x1 and y0 < r[3] and r[1] < y1:
+                    rects.remove(r)
+                    x0, y0, x1, y1 = min(x0, r[0]), min(y0, r[1]), max(x1, r[2]), max(y1, r[3])
+                    merged = True
+                    break
+        rects.append((x0, y0, x1, y1))
+    return [(slice(y0, y1), slice(x0, x1)) for x0, y0, x1, y1 in rects]
+
+
+def finder_windows(finders: list[ImageFinder], regions: list[tuple[slice, slice]]) \
+        -> list[tuple[int, slice, slice]]:
+    """
+    Locate the template rect of each image finder inside the merged region that contains it
+
+    :param finders: The image finders
+    :param regions: The merged regions (see union_regions)
+    :return: (region index, y slice, x slice relative to the region) of each finder
+    """
+    out = []
+    for f in finders:
+        for i, (ys, xs) in enumerate(regions):
+            if ys.start <= f.start[1] and f.end[1] <= ys.stop and xs.start <= f.start[0] and f.end[0] <= xs.stop:
+                out.append((i, slice(f.start[1] - ys.start, f.end[1] - ys.start),
+                            slice(f.start[0] - xs.start, f.end[0] - xs.start)))
+                break
+    return out
+
+
+class TemplateBank:
+    """
+    A set of ImageFinder templates compiled into one structure, so that all of them can be scored against a
+    frame in a single pass. Unlike checking each ImageFinder until the first hit, this returns the score of every
+    template, so ambiguous screens (more than one template above the threshold) become visible.
+
+    The widened region slices are prepared once at load time, and the scores are the same TM_CCOEFF_NORMED values
+    (over the same scale pyramid) that ImageFinder.check computes. Regions rejected by ImageFinder.prefilter are
+    not correlated and score -1.
+    """
+    names: list[str]
+    finders: dict[str, ImageFinder]
+    widen: int
+    regions: list[tuple[slice, slice]]
+
+    def __init__(self, finders: dict[str, ImageFinder], widen: int = 5):
+        self.finders = finders
+        self.names = list(finders)
+        self.widen = widen
+        self.regions = [(slice(max(f.start[1] - widen - f.margin, 0), f.end[1] + widen + f.margin),
+                         slice(max(f.start[0] - widen - f.margin, 0), f.end[0] + widen + f.margin))
+                        for f in finders.values()]
+
+    def scores(self, frame: ndarray) -> dict[str, float]:
+        """
+        Score every template against the frame
+
+        :param frame: The screen frame (grayscale)
+        :return: The best TM_CCOEFF_NORMED score of each template within its widened region
+        """
+        if len(frame.shape) == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        res = {}
+        for name, region in zip(self.names, self.regions):
+            region = frame[region]
+            check_stats['check'] += 1
+            reason = self.finders[name].prefilter(region)
+            if reason:
+                check_stats[f'reject_{reason}'] += 1
+                res[name] = -1.0
+                continue
+            res[name] = self.finders[name].score(region)
+            if res[name] > config.image_threshold:
+                check_stats['match'] += 1
+        return res
+
+    def match(self, frame: ndarray, threshold: float | None = None) -> list[tuple[str, float]]:
+        """
+        Find all templates that are on the screen
+
+        :param frame: The screen frame (grayscale)
+        :param threshold: The minimum score, defaults to config.image_threshold
+        :return: (name, score) of all matching templates, best match first
+        """
+        threshold = config.image_threshold if threshold is None else threshold
+        hits = [(k, v) for k, v in self.scores(frame).items() if v > threshold]
+        return sorted(hits, key=lambda x: x[1], reverse=True)
+
 
 def intersection(corner1: tuple[int, int], corner2: tuple[int, int], y_line: int) -> int:
     """
@@ -261,6 +599,103 @@ def center_of(wanted_size: tuple[int, int, int], top_left: tuple[int, int]) -> t
     return int(tl_x + w_src / 2), int(tl_y + h_src / 2)
 
 
+class ImageWriter:
+    """
+    Encodes and saves images on background threads, so that the frame callback never waits for cv2.imwrite.
+    The queue is bounded: when it is full, the oldest pending image is dropped.
+    """
+    def __init__(self, threads: int = 2, queue: int = 16):
+        self.threads = threads
+        self.queue: deque[tuple[Path, ndarray]] = deque(maxlen=queue)
+        self.cond = threading.Condition()
+        self.started = False
+        self.stats: Counter = Counter()  # 'written', 'dropped', 'failed'
+
+    def write(self, path: Path | str, img: ndarray) -> None:
+        """
+        Queue an image to be saved. The image must not be modified afterwards.
+
+        :param path: Output path, the format is picked from its extension (the directory is created if needed)
+        :param img: The image
+        """
+        with self.cond:
+            if not self.started:
+                for i in range(self.threads):
+                    threading.Thread(target=self._work, name=f'image-writer-{i}', daemon=True).start()
+                self.started = True
+            if len(self.queue) == self.queue.maxlen:
+                self.stats['dropped'] += 1
+            self.queue.append((Path(path), img))
+            self.cond.notify()
+
+    def depth(self) -> int:
+        """ Number of images waiting to be written """
+        return len(self.queue)
+
+    def _work(self) -> None:
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                path, img = self.queue.popleft()
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                ok = cv2.imwrite(str(path), img)
+            except (OSError, cv2.error) as e:
+                print(f"Failed to write {path}: {e}")
+                ok = False
+            with self.cond:
+                self.stats['written' if ok else 'failed'] += 1
+
+
+image_writer = ImageWriter()
+
+
+class FrameMailbox:
+    """
+    Holds only the latest frame from the scrcpy callback. The consumer waits for a frame newer than the last one it
+    handled, and frames that arrive in between simply replace each other, so the callback never blocks or queues.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frame: ndarray | None = None
+        self.seq = 0  # Number of frames received
+        self.time = 0  # Time (ns) at which the latest frame was received
+
+    def put(self, frame: ndarray) -> None:
+        with self.cond:
+            self.frame, self.seq, self.time = frame, self.seq + 1, time.time_ns()
+            self.cond.notify_all()
+
+    def get(self, after: int, timeout: float | None = None) -> tuple[int, ndarray, int] | None:
+        """
+        Wait for a frame newer than a sequence number
+
+        :param after: Sequence number of the last frame handled
+        :param timeout: Max wait in seconds
+        :return: (sequence number, frame, receive time in ns), or None on timeout
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > after, timeout):
+                return None
+            return self.seq, self.frame, self.time
+
+
+def sleep_until(deadline_ns: int, spin_ns: int = 1_500_000) -> None:
+    """
+    Sleep until time.time_ns() reaches the deadline. OS sleeps can overshoot by a millisecond or more, so the last
+    spin_ns are spent yielding in a loop instead.
+
+    :param deadline_ns: The time to wake up at (time.time_ns() clock)
+    :param spin_ns: How long before the deadline to stop sleeping and start spinning
+    """
+    remaining = deadline_ns - time.time_ns()
+    if remaining > spin_ns:
+        time.sleep((remaining - spin_ns) / 1e9)
+    while time.time_ns() < deadline_ns:
+        time.sleep(0)
+
+
 def priority_win():
     import win32api
     import win32process
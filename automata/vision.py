@@ -0,0 +1,117 @@
+"""
+Optional worker processes for stage detection
+
+With config.vision_workers > 0, find_stage ships the is_stage checks of frame-only stages to a process pool, so
+template matching doesn't compete for the GIL with the gamers' playback threads. Each session copies its frame into
+its own shared memory block, and the workers (which load their own copy of the stages) read it from there. Stages
+that depend on more than the frame (frame_only = False) are still checked in the main process.
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .metrics import stage_metrics
+from .models import SekaiStageContext, SekaiStage
+from .util import check_stats
+
+# Worker process state
+_stages: dict[str, SekaiStage] = {}
+_blocks: dict[int, shared_memory.SharedMemory] = {}  # Session key -> its frame block
+
+
+def _init_worker() -> None:
+    global _stages
+    from .stage import load_stages
+    _stages = load_stages()
+
+    # The automata restarts with os._exit, which gives the pool no chance to stop its workers
+    parent = multiprocessing.parent_process()
+    threading.Thread(target=lambda: parent.join() or os._exit(0), daemon=True).start()
+
+
+def _attach(key: int, name: str) -> shared_memory.SharedMemory:
+    # Pool workers share the resource tracker of the main process, which unlinks the blocks once every process exits
+    shm = _blocks.get(key)
+    if shm is None or shm.name != name:
+        # The session reallocated its block, drop the mapping of the old one so that its memory can be freed
+        shm and shm.close()
+        shm = _blocks[key] = shared_memory.SharedMemory(name=name)
+    return shm
+
+
+def _first_hit(key: int, block: str, shape: tuple, names: list[str], store: dict, time_ms: int) \
+        -> tuple[str | None, list[tuple[str, bool, float]], dict, dict, Counter]:
+    """
+    Check stages on the frame in a shared memory block, in order, until one matches (runs in a worker)
+
+    :return: The matching stage, (stage, verdict, seconds) of every check, the context cache and store after the
+        checks, and the ImageFinder check counters of this call
+    """
+    from .stage import get_rois
+
+    frame = np.ndarray(shape, np.uint8, _attach(key, block).buf)
+    ctx = SekaiStageContext(None, frame, {}, store, time_ms, None, rois=get_rois())
+    stats = check_stats.copy()
+    checked = []
+    hit = None
+    for name in names:
+        st = time.perf_counter()
+        res = bool(_stages[name].is_stage(ctx))
+        checked.append((name, res, time.perf_counter() - st))
+        if res:
+            hit = name
+            break
+    return hit, checked, ctx.cache, ctx.store, check_stats - stats
+
+
+class VisionPool:
+    def __init__(self, workers: int):
+        self.executor = ProcessPoolExecutor(workers, initializer=_init_worker)
+        self.blocks: dict[int, shared_memory.SharedMemory] = {}  # id(ctx) -> the session's frame block
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        """ Stop the workers and free the frame blocks """
+        self.executor.shutdown(cancel_futures=True)
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks.clear()
+
+    def first_hit(self, ctx: SekaiStageContext, names: list[str]) -> str | None:
+        """
+        Check frame-only stages on the current frame in a worker, in order, until one matches. Verdicts, metrics
+        and the context changes made by the matching stage are applied to ctx as if the checks ran here.
+
+        :param ctx: The context object
+        :param names: Names of the stages to check
+        :return: The name of the matching stage, None if none matches
+        """
+        shm = self.blocks.get(id(ctx))
+        if shm is None or shm.size < ctx.frame.nbytes:
+            # The frame grew (e.g. the stream reconnected at another size): free the old block first
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = self.blocks[id(ctx)] = shared_memory.SharedMemory(create=True, size=ctx.frame.nbytes)
+        np.ndarray(ctx.frame.shape, np.uint8, shm.buf)[...] = ctx.frame
+
+        hit, checked, cache, store, stats = self.executor.submit(
+            _first_hit, id(ctx), shm.name, ctx.frame.shape, names, ctx.store, ctx.time).result()
+
+        for name, res, seconds in checked:
+            stage_metrics.record(name, seconds, res)
+            ctx.verdicts[name] = res
+        check_stats.update(stats)
+        if hit:
+            ctx.cache.update(cache)
+            ctx.store.clear()
+            ctx.store.update(store)
+        return hit
@@ -0,0 +1,8 @@
+# Run all three emulators in one process (see start1.ps1 for one process per emulator)
+$env:ADB_SERIAL = "emulator-5554,emulator-5556,emulator-5558"
+$env:MODE = "helper"
+$env:CONFIG_PATH = "config-clover.toml"
+
+while ($true) {
+    python -m automata
+}